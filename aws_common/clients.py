@@ -0,0 +1,104 @@
+"""
+One place the tools get their AWS clients from.
+
+Clients are created on first use and kept per service, region and
+credentials, all from a single botocore session so the credential chain
+and the service models are only loaded once. The connection pool of
+every client is sized to the concurrency of the tool (botocore defaults
+to 10 connections, beyond which concurrent calls wait for one to free
+up). Every client goes through throttling.install, so it is rate
+limited, retried and instrumented.
+
+Module level clients outlive a Lambda invocation, so a warm container
+reuses its clients and their open connections.
+"""
+from aws_common import throttling
+from threading import Lock
+
+# botocore's own default
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+class ClientFactory(object):
+
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, throttler=None, recorder=None):
+        self.max_pool_connections = max_pool_connections
+        self.throttler = throttler
+        self.recorder = recorder
+        self.session = None
+        self.clients = {}
+        # boto3 sessions are not thread safe, clients are
+        self.lock = Lock()
+
+    def set_concurrency(self, concurrency):
+        """
+        Make room in the connection pools for this many concurrent calls.
+        Only applies to the clients created afterwards.
+        """
+        self.max_pool_connections = max(self.max_pool_connections, concurrency)
+
+    def client(self, service, region=None, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None):
+        """
+        Return the client of service in region for these credentials,
+        creating it on first use. Without keys the default credential chain
+        is used.
+        """
+        key = (service, region, aws_access_key_id, aws_secret_access_key, aws_session_token)
+        client = self.clients.get(key)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    if self.session is None:
+                        # boto3 is only imported once a client is needed
+                        import boto3.session
+                        self.session = boto3.session.Session()
+                    client = self.session.client(service, region_name=region,
+                                                 aws_access_key_id=aws_access_key_id,
+                                                 aws_secret_access_key=aws_secret_access_key,
+                                                 aws_session_token=aws_session_token,
+                                                 config=throttling.client_config(max_pool_connections=self.max_pool_connections))
+                    client = throttling.install(client, service, region, self.throttler, self.recorder)
+                    self.clients[key] = client
+        return client
+
+    def regional(self, service, regions, **credentials):
+        return RegionalClients(self, service, regions, credentials)
+
+    def clear(self):
+        with self.lock:
+            self.clients = {}
+
+
+class RegionalClients(object):
+    """
+    Read only {region: client} mapping creating each client when the region
+    is first used
+    """
+
+    def __init__(self, factory, service, regions, credentials):
+        self.factory = factory
+        self.service = service
+        self.regions = list(regions)
+        self.credentials = credentials
+
+    def __getitem__(self, region):
+        if region not in self.regions:
+            raise KeyError(region)
+        return self.factory.client(self.service, region, **self.credentials)
+
+    def __contains__(self, region):
+        return region in self.regions
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+
+DEFAULT_FACTORY = ClientFactory()
+
+client = DEFAULT_FACTORY.client
+regional = DEFAULT_FACTORY.regional
+set_concurrency = DEFAULT_FACTORY.set_concurrency
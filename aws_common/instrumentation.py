@@ -0,0 +1,321 @@
+"""
+Where the time of a run goes: per service and operation AWS call counts,
+attempt latency histograms, retries, throttles and bytes, timing spans for
+the stages of the tools, and plain counters.
+
+Boto3 clients are hooked through their event system, other objects (the
+offline fakes) are wrapped in an InstrumentedClient. throttling.install
+instruments every client it is given, so every client the tools create is
+covered. The report is written as JSON or Prometheus text.
+"""
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+from threading import Lock, local
+import json
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+THROTTLE_CODES = set(['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                      'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                      'LimitExceededException', 'ProvisionedThroughputExceededException',
+                      'PriorRequestNotComplete', 'SlowDown', 'BandwidthLimitExceeded'])
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return [(upper bound, count of observations up to it)], the last
+        bound being '+Inf'
+        """
+        result = []
+        total = 0
+        for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(("{0}".format(bound), count) for bound, count in self.cumulative())}
+
+
+def _new_operation():
+    return {'calls': 0, 'errors': 0, 'attempts': 0, 'retries': 0, 'throttles': 0,
+            'request_bytes': 0, 'response_bytes': 0, 'call_seconds': 0.0, 'latency': Histogram()}
+
+
+class Recorder(object):
+    """
+    Thread safe store of the measurements of a run
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.operations = {}
+            self.spans = {}
+            self.counters = {}
+
+    def _operation(self, service, operation):
+        key = (service, operation)
+        if key not in self.operations:
+            self.operations[key] = _new_operation()
+        return self.operations[key]
+
+    def record_attempt(self, service, operation, seconds, code=None, request_bytes=0, response_bytes=0):
+        """
+        One HTTP request (or fake call), code being its error code if any
+        """
+        with self.lock:
+            stats = self._operation(service, operation)
+            stats['attempts'] += 1
+            stats['latency'].observe(seconds)
+            stats['request_bytes'] += request_bytes
+            stats['response_bytes'] += response_bytes
+            if code in THROTTLE_CODES:
+                stats['throttles'] += 1
+
+    def record_call(self, service, operation, seconds, retries=0, error=False):
+        """
+        One API call as seen by the caller, including retries and waits
+        """
+        with self.lock:
+            stats = self._operation(service, operation)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['call_seconds'] += seconds
+            if error:
+                stats['errors'] += 1
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time a stage of a run: with recorder.span('fetch'): ...
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                if name not in self.spans:
+                    self.spans[name] = Histogram()
+                self.spans[name].observe(elapsed)
+
+    def to_dict(self):
+        with self.lock:
+            operations = {}
+            for (service, operation), stats in sorted(self.operations.items()):
+                operations["{0}.{1}".format(service, operation)] = dict(stats, latency=stats['latency'].to_dict())
+            return {'elapsed': time.time() - self.started,
+                    'operations': operations,
+                    'spans': dict((name, histogram.to_dict()) for name, histogram in sorted(self.spans.items())),
+                    'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            operations = sorted(self.operations.items())
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+
+        for metric, key in (('calls', 'calls'), ('errors', 'errors'), ('attempts', 'attempts'),
+                            ('retries', 'retries'), ('throttles', 'throttles'),
+                            ('request_bytes', 'request_bytes'), ('response_bytes', 'response_bytes')):
+            lines.append("# TYPE aws_api_{0}_total counter".format(metric))
+            for (service, operation), stats in operations:
+                lines.append('aws_api_{0}_total{{service="{1}",operation="{2}"}} {3}'.format(metric, service, operation, stats[key]))
+
+        lines.append("# TYPE aws_api_call_seconds_total counter")
+        for (service, operation), stats in operations:
+            lines.append('aws_api_call_seconds_total{{service="{0}",operation="{1}"}} {2}'.format(service, operation, stats['call_seconds']))
+
+        lines.append("# TYPE aws_api_attempt_seconds histogram")
+        for (service, operation), stats in operations:
+            lines.extend(_histogram_lines('aws_api_attempt_seconds', 'service="{0}",operation="{1}"'.format(service, operation), stats['latency']))
+
+        lines.append("# TYPE stage_seconds histogram")
+        for name, histogram in spans:
+            lines.extend(_histogram_lines('stage_seconds', 'stage="{0}"'.format(name), histogram))
+
+        lines.append("# TYPE events_total counter")
+        for name, value in counters:
+            lines.append('events_total{{name="{0}"}} {1}'.format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Return a short text report: stages, then operations by time spent.
+        Concurrent stages and calls can add up to more than the elapsed time.
+        """
+        report = self.to_dict()
+        lines = ["Elapsed: {0:.1f}s".format(report['elapsed'])]
+        for name, span in sorted(report['spans'].items(), key=lambda item: -item[1]['sum']):
+            lines.append("stage {0:<36} {1:>9.3f}s {2:>5.1f}% {3:>6} runs".format(
+                name, span['sum'], 100 * span['sum'] / max(report['elapsed'], 1e-9), span['count']))
+        for name, stats in sorted(report['operations'].items(), key=lambda item: -item[1]['call_seconds']):
+            lines.append("call  {0:<36} {1:>9.3f}s {2:>5.1f}% {3:>6} calls {4:>5} retries {5:>5} throttles {6:>5} errors".format(
+                name, stats['call_seconds'], 100 * stats['call_seconds'] / max(report['elapsed'], 1e-9),
+                stats['calls'], stats['retries'], stats['throttles'], stats['errors']))
+        for name, value in sorted(report['counters'].items()):
+            lines.append("count {0:<36} {1:>9}".format(name, value))
+        return "\n".join(lines)
+
+    def write(self, path, output_format=None):
+        """
+        Write the report to path, as JSON for .json files (or
+        output_format='json') and as Prometheus text otherwise
+        """
+        if output_format is None:
+            output_format = 'json' if path.endswith('.json') else 'prometheus'
+        with open(path, 'w') as f:
+            f.write(self.to_json() if output_format == 'json' else self.to_prometheus())
+
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    for bound, count in histogram.cumulative():
+        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, count))
+    lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, histogram.sum))
+    lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+    return lines
+
+
+DEFAULT_RECORDER = Recorder()
+
+span = DEFAULT_RECORDER.span
+add = DEFAULT_RECORDER.add
+
+
+class InstrumentedClient(object):
+    """
+    Record the calls of an object that is not a botocore client, turning
+    method names into operation names. Every call is one attempt; with
+    record_calls False only the attempts are recorded, the ThrottledClient
+    around it recording the calls and their retries.
+    """
+
+    def __init__(self, client, recorder, service, record_calls=True):
+        self.client = client
+        self.recorder = recorder
+        self.service = service
+        self.record_calls = record_calls
+
+    def _wrap(self, method, name):
+        operation = ''.join(part.capitalize() for part in name.split('_'))
+
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            code = None
+            try:
+                return method(*args, **kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                raise
+            finally:
+                elapsed = time.time() - start
+                self.recorder.record_attempt(self.service, operation, elapsed, code)
+                if self.record_calls:
+                    self.recorder.record_call(self.service, operation, elapsed, error=code is not None)
+        return instrumented
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name == 'get_paginator':
+            def get_paginator(operation_name):
+                paginator = attribute(operation_name)
+                paginator.method = self._wrap(paginator.method, operation_name)
+                return paginator
+            return get_paginator
+
+        if name.startswith('_') or isinstance(attribute, type) or not callable(attribute):
+            return attribute
+        return self._wrap(attribute, name)
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0
+
+
+def instrument(client, service, recorder=None):
+    """
+    Record the calls of client. Return the client to use.
+    """
+    recorder = recorder if recorder else DEFAULT_RECORDER
+
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return InstrumentedClient(client, recorder, service)
+
+    event_id = client.meta.service_model.service_id.hyphenize()
+    # A thread sends one request at a time
+    attempt = local()
+
+    def before_call(context=None, **kwargs):
+        if context is not None:
+            context['instrumentation_start'] = time.time()
+
+    def before_send(request=None, **kwargs):
+        attempt.start = time.time()
+        attempt.request_bytes = _body_size(getattr(request, 'body', None))
+
+    def needs_retry(event_name, response=None, **kwargs):
+        start = getattr(attempt, 'start', None)
+        if start is None:
+            return None
+        attempt.start = None
+
+        code = None
+        response_bytes = 0
+        if response:
+            code = response[1].get('Error', {}).get('Code')
+            response_bytes = int(response[0].headers.get('Content-Length') or 0)
+        recorder.record_attempt(service, event_name.rsplit('.', 1)[-1], time.time() - start, code,
+                                attempt.request_bytes, response_bytes)
+        return None
+
+    def after_call(event_name, http_response=None, context=None, **kwargs):
+        context = context if context is not None else {}
+        start = context.get('instrumentation_start', time.time())
+        retries = context.get('retries', {}).get('attempt', 1) - 1
+        error = http_response is None or http_response.status_code >= 300
+        recorder.record_call(service, event_name.rsplit('.', 1)[-1], time.time() - start, retries, error)
+
+    events.register("before-call.{0}".format(event_id), before_call)
+    events.register("before-send.{0}".format(event_id), before_send)
+    events.register("needs-retry.{0}".format(event_id), needs_retry)
+    events.register("after-call.{0}".format(event_id), after_call)
+    events.register("after-call-error.{0}".format(event_id), after_call)
+    return client
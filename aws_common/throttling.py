@@ -0,0 +1,311 @@
+"""
+Client side rate limiting and retries shared by the AWS tools.
+
+Every API call first takes a token from the bucket of its service, region
+and operation, refilled at the documented AWS request rate. Throttling and
+transient errors are retried with full jitter exponential backoff, as long
+as the shared retry budget allows (retries withdraw from it, successes pay
+it back), and every throttle halves the rate of its bucket, which then
+creeps back up on successful calls.
+
+Boto3 clients are hooked through their before-send and needs-retry events,
+so paginators are covered too. Other objects (the offline fakes) are
+wrapped in a ThrottledClient.
+"""
+from aws_common import instrumentation
+from aws_common.instrumentation import THROTTLE_CODES
+from botocore.exceptions import ClientError
+from threading import Lock
+import random
+import time
+
+# (requests per second, burst) per service and operation, '*' for the
+# operations not listed. Route53 allows 5 requests per second per account,
+# EC2 refills describe calls at 20 per second with a burst of 100.
+RATE_LIMITS = {
+    'route53': {'*': (5, 5)},
+    'ec2': {'*': (20, 100)},
+    'kinesis': {'DescribeStream': (10, 10),
+                'DescribeStreamSummary': (20, 20),
+                'ListShards': (100, 100),
+                'ListStreams': (5, 5),
+                'DescribeLimits': (1, 1),
+                'SplitShard': (5, 5),
+                'MergeShards': (5, 5),
+                'UpdateShardCount': (2, 2),
+                '*': (10, 10)},
+    'cloudwatch': {'GetMetricData': (50, 50), '*': (20, 20)},
+    'cloudformation': {'*': (5, 5)},
+}
+DEFAULT_RATE_LIMIT = (10, 10)
+
+TRANSIENT_CODES = set(['RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure',
+                       'InternalServiceError', 'ServiceUnavailable', 'Unavailable'])
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+
+# Retry budget, like the botocore standard retry quota
+RETRY_BUDGET = 500
+THROTTLE_RETRY_COST = 5
+TRANSIENT_RETRY_COST = 10
+SUCCESS_REFUND = 1
+
+# Lowest share of the quota a bucket slows down to after throttles, and the
+# share of the quota won back by each successful call
+MIN_RATE_RATIO = 0.25
+RATE_INCREASE_RATIO = 0.05
+
+
+class TokenBucket(object):
+    """
+    Blocking token bucket whose rate adapts to throttling
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.time()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until it is available.
+        Return the seconds waited.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Reserve the token now so concurrent callers queue up fairly
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_RATIO, self.rate / 2)
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_RATIO)
+
+
+class RetryBudget(object):
+
+    def __init__(self, capacity=RETRY_BUDGET):
+        self.capacity = capacity
+        self.available = capacity
+        self.lock = Lock()
+
+    def withdraw(self, cost):
+        with self.lock:
+            if self.available < cost:
+                return False
+            self.available -= cost
+            return True
+
+    def refund(self, amount=SUCCESS_REFUND):
+        if self.available < self.capacity:
+            with self.lock:
+                self.available = min(self.capacity, self.available + amount)
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+class Throttler(object):
+    """
+    Token buckets, retry budget and call statistics shared by all the
+    clients of a process
+    """
+
+    def __init__(self, rate_limits=None, max_attempts=MAX_ATTEMPTS, budget=None, rate_limited=True):
+        self.rate_limits = rate_limits if rate_limits else RATE_LIMITS
+        # Without rate limiting only the retries are left, e.g. for fakes
+        self.rate_limited = rate_limited
+        self.max_attempts = max_attempts
+        self.budget = budget if budget else RetryBudget()
+        self.buckets = {}
+        self.stats = {}
+        self.lock = Lock()
+
+    def bucket(self, service, region, operation):
+        limits = self.rate_limits.get(service, {})
+        if operation not in limits:
+            operation = '*'
+        key = (service, region, operation)
+
+        if key not in self.buckets:
+            with self.lock:
+                if key not in self.buckets:
+                    self.buckets[key] = TokenBucket(*limits.get(operation, DEFAULT_RATE_LIMIT))
+        return self.buckets[key]
+
+    def _count(self, service, operation, key, value=1):
+        name = "{0}.{1}".format(service, operation)
+        with self.lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'throttles': 0, 'retries': 0, 'gave_up': 0, 'waited': 0.0})
+            stats[key] += value
+
+    def before_call(self, service, region, operation):
+        waited = self.bucket(service, region, operation).acquire() if self.rate_limited else 0
+        self._count(service, operation, 'calls')
+        if waited:
+            self._count(service, operation, 'waited', waited)
+
+    def after_success(self, service, region, operation):
+        self.bucket(service, region, operation).on_success()
+        self.budget.refund()
+
+    def retry_delay(self, service, region, operation, code, attempt, transient=False):
+        """
+        Return the seconds to wait before retrying a failed call, None if
+        it should not be retried. attempt counts from 1.
+        """
+        if code in THROTTLE_CODES:
+            self.bucket(service, region, operation).on_throttle()
+            self._count(service, operation, 'throttles')
+            cost = THROTTLE_RETRY_COST
+        elif transient or code in TRANSIENT_CODES:
+            cost = TRANSIENT_RETRY_COST
+        else:
+            return None
+
+        if attempt >= self.max_attempts or not self.budget.withdraw(cost):
+            self._count(service, operation, 'gave_up')
+            return None
+
+        self._count(service, operation, 'retries')
+        return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1)))
+
+    def call(self, service, region, operation, func, args=(), kwargs=None, recorder=None):
+        """
+        Call func(*args, **kwargs) with rate limiting and retries,
+        recording the call in recorder
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.before_call(service, region, operation)
+            try:
+                result = func(*args, **(kwargs or {}))
+            except ClientError as e:
+                delay = self.retry_delay(service, region, operation, error_code(e), attempt)
+                if delay is None:
+                    if recorder:
+                        recorder.record_call(service, operation, time.time() - start, attempt - 1, error=True)
+                    raise
+                time.sleep(delay)
+                continue
+            self.after_success(service, region, operation)
+            if recorder:
+                recorder.record_call(service, operation, time.time() - start, attempt - 1)
+            return result
+
+    def report(self):
+        """
+        Return one line per operation with its call statistics
+        """
+        lines = []
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            lines.append("{0}: {1} calls, {2} throttles, {3} retries, {4} gave up, {5:.1f}s waited for tokens".format(
+                name, stats['calls'], stats['throttles'], stats['retries'], stats['gave_up'], stats['waited']))
+        return "\n".join(lines)
+
+
+class ThrottledClient(object):
+    """
+    Rate limit and retry the calls of an object that is not a botocore
+    client, turning method names into operation names. The calls, with
+    their retries, are recorded in recorder.
+    """
+
+    def __init__(self, client, throttler, service, region=None, recorder=None):
+        self.client = client
+        self.throttler = throttler
+        self.service = service
+        self.region = region
+        self.recorder = recorder
+
+    def _wrap(self, method, name):
+        operation = ''.join(part.capitalize() for part in name.split('_'))
+
+        def throttled(*args, **kwargs):
+            return self.throttler.call(self.service, self.region, operation, method, args, kwargs, self.recorder)
+        return throttled
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name == 'get_paginator':
+            def get_paginator(operation_name):
+                paginator = attribute(operation_name)
+                paginator.method = self._wrap(paginator.method, operation_name)
+                return paginator
+            return get_paginator
+
+        if name.startswith('_') or isinstance(attribute, type) or not callable(attribute):
+            return attribute
+        return self._wrap(attribute, name)
+
+
+DEFAULT_THROTTLER = Throttler()
+
+
+def client_config(**kwargs):
+    """
+    botocore Config for clients passed to install. botocore's own retries
+    are turned off so they do not stack with ours.
+    """
+    # Imported on first use, it costs a tenth of a second at startup
+    from botocore.config import Config
+    return Config(retries={'total_max_attempts': 1, 'mode': 'standard'}, **kwargs)
+
+
+def install(client, service, region=None, throttler=None, recorder=None):
+    """
+    Rate limit, retry and instrument the calls of client.
+    Return the client to use.
+    """
+    throttler = throttler if throttler else DEFAULT_THROTTLER
+    recorder = recorder if recorder else instrumentation.DEFAULT_RECORDER
+
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        client = instrumentation.InstrumentedClient(client, recorder, service, record_calls=False)
+        return ThrottledClient(client, throttler, service, region, recorder)
+
+    event_id = client.meta.service_model.service_id.hyphenize()
+
+    def before_send(event_name, **kwargs):
+        throttler.before_call(service, region, event_name.rsplit('.', 1)[-1])
+
+    def needs_retry(event_name, response=None, attempts=1, caught_exception=None, **kwargs):
+        operation = event_name.rsplit('.', 1)[-1]
+        if caught_exception is not None:
+            return throttler.retry_delay(service, region, operation, None, attempts, transient=True)
+
+        code = response[1].get('Error', {}).get('Code') if response else None
+        status = response[0].status_code if response else None
+        if code is None and status is not None and status < 500:
+            throttler.after_success(service, region, operation)
+            return None
+        return throttler.retry_delay(service, region, operation, code, attempts,
+                                     transient=status is not None and status >= 500)
+
+    events.register("before-send.{0}".format(event_id), before_send)
+    events.register("needs-retry.{0}".format(event_id), needs_retry)
+    # Registered after the token wait, so it only measures the requests
+    return instrumentation.instrument(client, service, recorder)
@@ -0,0 +1,173 @@
+"""
+Time the cold start of the ECS AMI update Lambda locally, with the sample
+SNS event and a stubbed CloudFormation client.
+
+Every cold run is a fresh interpreter, like a new Lambda container:
+- import: importing lambda_function, the init phase of a container
+- init: what the first invocation costs on top of a warm one (boto3,
+  session, clients, settings)
+- handler: a warm invocation
+
+The medians of the runs are reported, along with the Python, boto3 and
+botocore versions, so the numbers can be compared across releases run on
+the same machine. No AWS account is used: the stub answers describe_stacks
+and update_stack before any request is sent.
+"""
+import subprocess
+import statistics
+import argparse
+import json
+import time
+import sys
+import os
+
+SAMPLE_EVENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_event.json")
+PARAMETER_NAME = "AmiId"
+PREVIOUS_AMI_ID = "ami-00000000000000000"
+
+
+def stub_cloudformation(session):
+    """
+    Answer the CloudFormation calls of the clients of session, every stack
+    still using PREVIOUS_AMI_ID
+    """
+    from botocore.awsrequest import AWSResponse
+    from datetime import datetime
+
+    def respond(model, params, **kwargs):
+        # params is the serialized request, its body holds the API parameters
+        stack_name = params["body"]["StackName"]
+        if model.name == "DescribeStacks":
+            parsed = {
+                "Stacks": [
+                    {
+                        "StackName": stack_name,
+                        "CreationTime": datetime(2021, 1, 1),
+                        "StackStatus": "UPDATE_COMPLETE",
+                        "Parameters": [
+                            {"ParameterKey": PARAMETER_NAME, "ParameterValue": PREVIOUS_AMI_ID},
+                            {"ParameterKey": "DesiredCapacity", "ParameterValue": "3"},
+                        ],
+                    }
+                ]
+            }
+        elif model.name == "UpdateStack":
+            parsed = {"StackId": f"arn:aws:cloudformation:::stack/{stack_name}/0"}
+        else:
+            raise Exception(f"{model.name} is not stubbed")
+        return AWSResponse(None, 200, {}, None), parsed
+
+    session.events.register("before-call.cloudformation", respond)
+
+
+def measure(invocations):
+    """
+    Import the function and invoke it invocations times in this process.
+    Return the timings in seconds.
+    """
+    with open(SAMPLE_EVENT) as f:
+        event = json.load(f)
+
+    start = time.perf_counter()
+    import lambda_function
+    from aws_common import clients
+
+    imported = time.perf_counter()
+
+    # The handler would create the session itself, the stub has to be
+    # registered on it before any client is created
+    import boto3.session
+
+    session = boto3.session.Session()
+    stub_cloudformation(session)
+    clients.DEFAULT_FACTORY.session = session
+    result = lambda_function.handler(event, None)
+    if result["failed"]:
+        raise Exception(f"Stack updates failed: {result['results']}")
+    cold = time.perf_counter() - imported
+
+    warm = []
+    for i in range(invocations):
+        invoked = time.perf_counter()
+        lambda_function.handler(event, None)
+        warm.append(time.perf_counter() - invoked)
+
+    handler = statistics.median(warm) if warm else 0.0
+    return {"import": imported - start, "init": max(cold - handler, 0.0), "handler": handler}
+
+
+def cold_run(stacks, invocations):
+    """
+    Run measure in a fresh interpreter, updating stacks stacks
+    """
+    with open(SAMPLE_EVENT) as f:
+        regions = sorted(json.loads(json.load(f)["Records"][0]["Sns"]["Message"])["ECSAmis"][0]["Regions"])
+    targets = [
+        {"region": regions[i % len(regions)], "stack_name": f"ecs-cluster-{i}", "parameter_name": PARAMETER_NAME}
+        for i in range(stacks)
+    ]
+
+    environ = dict(
+        os.environ,
+        AWS_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        TARGETS=json.dumps(targets),
+    )
+    for name in ("IDEMPOTENCY_TABLE", "IDEMPOTENCY_FILE", "CHANGE_SET_MODE", "DISCOVERY_REGIONS"):
+        environ.pop(name, None)
+
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--measure", "--invocations", str(invocations)],
+        env=environ,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    # The timings are the last line, after anything the function printed
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def versions():
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import boto3, botocore, platform; print(platform.python_version(), boto3.__version__, botocore.__version__)",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.split()
+    return dict(zip(("python", "boto3", "botocore"), output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cold and warm starts of the ECS AMI update Lambda")
+    parser.add_argument("--runs", "-n", dest="runs", type=int, default=10, help="Number of cold starts, each in a new interpreter")
+    parser.add_argument("--invocations", dest="invocations", type=int, default=20, help="Number of warm invocations after every cold start")
+    parser.add_argument("--stacks", dest="stacks", type=int, default=1, help="Number of stacks updated per invocation, spread over the regions of the event")
+    parser.add_argument("--json", dest="json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--measure", dest="measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # Keep the function's per invocation logs out of the timings
+        import logging
+
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(measure(args.invocations)))
+        sys.exit(0)
+
+    runs = [cold_run(args.stacks, args.invocations) for i in range(args.runs)]
+    report = dict(versions(), runs=args.runs, invocations=args.invocations, stacks=args.stacks)
+    for phase in ("import", "init", "handler"):
+        report[phase] = statistics.median(run[phase] for run in runs)
+
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        print(f"Python {report['python']}, boto3 {report['boto3']}, botocore {report['botocore']}")
+        print(f"{args.runs} cold starts, {args.invocations} warm invocations each, {args.stacks} stacks")
+        for phase in ("import", "init", "handler"):
+            print(f"{phase:<8} {report[phase] * 1000:>9.1f}ms (median)")
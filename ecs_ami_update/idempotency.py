@@ -0,0 +1,104 @@
+"""
+Stores of the stack updates already done, so SNS re-deliveries of an AMI
+notification do not update (or even describe) the stacks again.
+
+A record is kept per stack, AMI id parameter and AMI id. FileStore keeps
+them in a local JSON file, e.g. in /tmp which survives between the
+invocations of a warm container, and needs no AWS resources.
+DynamoDBStore shares them between all the containers of the function.
+"""
+from threading import Lock
+import json
+import time
+import os
+
+# Seconds a record is kept
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+def record_key(region, stack_name, parameter_name, ami_id):
+    return f"{region}/{stack_name}/{parameter_name}/{ami_id}"
+
+
+class IdempotencyStore(object):
+    """
+    Store doing nothing, every update is attempted
+    """
+
+    def seen(self, key):
+        return False
+
+    def record(self, key):
+        pass
+
+
+class FileStore(IdempotencyStore):
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.records = None
+        self.lock = Lock()
+
+    def _load(self):
+        if self.records is None:
+            try:
+                with open(self.path) as f:
+                    self.records = json.load(f)
+            except (IOError, ValueError):
+                self.records = {}
+        return self.records
+
+    def seen(self, key):
+        with self.lock:
+            recorded_at = self._load().get(key)
+        return recorded_at is not None and time.time() - recorded_at < self.ttl
+
+    def record(self, key):
+        with self.lock:
+            now = time.time()
+            records = dict(
+                (name, recorded_at)
+                for name, recorded_at in self._load().items()
+                if now - recorded_at < self.ttl
+            )
+            records[key] = now
+            self.records = records
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(records, f)
+            os.replace(self.path + ".tmp", self.path)
+
+
+class DynamoDBStore(IdempotencyStore):
+    """
+    Records in a DynamoDB table with a string hash key "key" and, for
+    expiry, a TTL attribute "expires_at"
+    """
+
+    def __init__(self, client, table, ttl=DEFAULT_TTL):
+        self.client = client
+        self.table = table
+        self.ttl = ttl
+
+    def seen(self, key):
+        response = self.client.get_item(TableName=self.table, Key={"key": {"S": key}}, ConsistentRead=True)
+        item = response.get("Item")
+        return item is not None and int(item["expires_at"]["N"]) > time.time()
+
+    def record(self, key):
+        self.client.put_item(
+            TableName=self.table,
+            Item={"key": {"S": key}, "expires_at": {"N": str(int(time.time() + self.ttl))}},
+        )
+
+
+def get_store(environ, client_factory=None):
+    """
+    Return the store configured by IDEMPOTENCY_TABLE (DynamoDB) or
+    IDEMPOTENCY_FILE, an IdempotencyStore doing nothing otherwise
+    """
+    ttl = int(environ.get("IDEMPOTENCY_TTL", DEFAULT_TTL))
+    if environ.get("IDEMPOTENCY_TABLE"):
+        return DynamoDBStore(client_factory("dynamodb"), environ["IDEMPOTENCY_TABLE"], ttl)
+    if environ.get("IDEMPOTENCY_FILE"):
+        return FileStore(environ["IDEMPOTENCY_FILE"], ttl)
+    return IdempotencyStore()
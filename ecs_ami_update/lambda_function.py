@@ -1,15 +1,61 @@
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import idempotency
 import traceback
 import logging
-import boto3
 import json
+import time
 import sys
 import os
 
-client = boto3.client("cloudformation")
-stack_name = ""
-ami_id_parameter_name = ""
-region = os.environ["AWS_REGION"]
+# aws_common is either bundled next to this file in the deployment package
+# or found at the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aws_common import clients, instrumentation
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Stacks carrying this tag are updated, the tag value being the name of
+# their AMI id parameter
+DEFAULT_DISCOVERY_TAG = "ecs-ami-update:parameter"
+DEFAULT_MAX_WORKERS = 10
+
+CHANGE_SET_INITIAL_DELAY = 1
+CHANGE_SET_MAX_DELAY = 5
+CHANGE_SET_MAX_WAIT = 60
+
+# CloudFormation errors and change set reasons meaning the stack already
+# has these parameters
+NO_CHANGE_REASONS = ("No updates are to be performed", "didn't contain changes")
+
+# Created on the first invocation, kept while the container is warm
+idempotency_store = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings():
+    """
+    Parse the environment once per container, on the first invocation
+    """
+    environ = os.environ
+    return {
+        "region": environ["AWS_REGION"],
+        # Single target, kept for existing deployments
+        "stack_name": environ.get("STACK_NAME", ""),
+        "ami_id_parameter_name": environ.get("AMI_ID_PARAMETER_NAME", ""),
+        "targets": json.loads(environ["TARGETS"]) if environ.get("TARGETS") else None,
+        "discovery_regions": [
+            name.strip() for name in environ.get("DISCOVERY_REGIONS", "").split(",") if name.strip()
+        ],
+        "discovery_tag": environ.get("DISCOVERY_TAG", DEFAULT_DISCOVERY_TAG),
+        "max_workers": int(environ.get("MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+        # Empty to call update_stack directly, "preview" to only report the
+        # resources a change set would replace, "execute" to report and
+        # execute it
+        "change_set_mode": environ.get("CHANGE_SET_MODE", ""),
+    }
 
 
 def handle_exception(e):
@@ -26,46 +72,291 @@ def handle_exception(e):
 
 
 def handler(event, context):
-    # grab the ami id from the event
+    # The recorder lives as long as the container, report this invocation only
+    instrumentation.DEFAULT_RECORDER.reset()
+    try:
+        return update_ami(event)
+    finally:
+        logger.info(json.dumps({"instrumentation": instrumentation.DEFAULT_RECORDER.to_dict()}))
+
+
+def get_ami_ids(event):
+    """
+    Return {region: ami id} from the SNS event
+    """
     # refer the sample event for message format
     # https://docs.aws.amazon.com/AmazonECS/latest/developerguide/ECS-AMI-SubscribeTopic.html#ECS-AMI-Notification-format
+    message = json.loads(event["Records"][0]["Sns"]["Message"])
+    return dict(
+        (ami_region, details["ImageId"])
+        for ami_region, details in message["ECSAmis"][0]["Regions"].items()
+    )
+
+
+def discover_targets(regions, tag_key):
+    """
+    Return a target for every stack of regions tagged with tag_key. The
+    parameters of the stack come with it, saving a describe_stacks call.
+    Return (targets, failures), failures being the failed results of the
+    regions that could not be searched.
+    """
+    targets = []
+    failures = []
+    for stack_region in regions:
+        region_targets = []
+        try:
+            client = clients.client("cloudformation", stack_region)
+            for page in client.get_paginator("describe_stacks").paginate():
+                for stack in page["Stacks"]:
+                    # Nested stacks inherit the tags of their parent, which
+                    # passes the new AMI id down itself
+                    if stack.get("ParentId") or stack.get("RootId"):
+                        continue
+                    tags = dict((tag["Key"], tag["Value"]) for tag in stack.get("Tags", []))
+                    if tag_key in tags:
+                        region_targets.append(
+                            {
+                                "region": stack_region,
+                                "stack_name": stack["StackName"],
+                                "parameter_name": tags[tag_key],
+                                "parameters": stack.get("Parameters", []),
+                            }
+                        )
+        except Exception as e:
+            print(f"Error discovering stacks in {stack_region}")
+            handle_exception(e)
+            failures.append({"region": stack_region, "stack_name": None, "status": "failed", "error": str(e)})
+            continue
+        targets.extend(region_targets)
+    return targets, failures
+
+
+def get_targets():
+    """
+    Return the stacks to update as [{region, stack_name, parameter_name}],
+    from (in order of precedence):
+    - TARGETS: JSON list of such objects
+    - DISCOVERY_REGIONS: comma separated regions searched for stacks with
+      the DISCOVERY_TAG tag
+    - STACK_NAME and AMI_ID_PARAMETER_NAME, in the region of the function
+    Return (targets, failures) as discover_targets does.
+    """
+    settings = get_settings()
+    if settings["targets"]:
+        return settings["targets"], []
+
+    if settings["discovery_regions"]:
+        return discover_targets(settings["discovery_regions"], settings["discovery_tag"])
+
+    targets = [
+        {
+            "region": settings["region"],
+            "stack_name": settings["stack_name"],
+            "parameter_name": settings["ami_id_parameter_name"],
+        }
+    ]
+    return targets, []
+
+
+def parameter_value(parameters, name):
+    for parameter in parameters:
+        if parameter["ParameterKey"] == name:
+            return parameter.get("ResolvedValue", parameter.get("ParameterValue"))
+    return None
+
+
+def no_changes(message):
+    return any(reason in message for reason in NO_CHANGE_REASONS)
+
+
+def run_change_set(client, target, parameters, ami_id, mode):
+    """
+    Create a change set with the new parameters and return the logical
+    ids of the resources it replaces (or may replace), or None when it
+    has no changes. The change set is executed in "execute" mode and
+    deleted in "preview" mode.
+    """
+    response = client.create_change_set(
+        StackName=target["stack_name"],
+        ChangeSetName=f"ecs-ami-update-{ami_id}-{int(time.time())}",
+        ChangeSetType="UPDATE",
+        UsePreviousTemplate=True,
+        Parameters=parameters,
+    )
+    change_set_id = response["Id"]
+
+    delay = CHANGE_SET_INITIAL_DELAY
+    waited = 0
+    while True:
+        change_set = client.describe_change_set(ChangeSetName=change_set_id)
+        if change_set["Status"] not in ("CREATE_PENDING", "CREATE_IN_PROGRESS") or waited >= CHANGE_SET_MAX_WAIT:
+            break
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, CHANGE_SET_MAX_DELAY)
+
+    if change_set["Status"] != "CREATE_COMPLETE":
+        client.delete_change_set(ChangeSetName=change_set_id)
+        reason = change_set.get("StatusReason", change_set["Status"])
+        if no_changes(reason):
+            return None
+        raise Exception(f"Change set {change_set_id} not created: {reason}")
+
+    replacements = [
+        change["ResourceChange"]["LogicalResourceId"]
+        for change in change_set.get("Changes", [])
+        if change.get("ResourceChange", {}).get("Replacement") in ("True", "Conditional")
+    ]
+    if mode == "execute":
+        client.execute_change_set(ChangeSetName=change_set_id)
+    else:
+        client.delete_change_set(ChangeSetName=change_set_id)
+    return replacements
+
+
+def record_done(store, key, result):
+    """
+    Remember the target is done. The stack is already up to date, so a
+    failure is only reported in the result: the next delivery checks the
+    stack again.
+    """
     try:
-        message = json.loads(event["Records"][0]["Sns"]["Message"])
-        ami_id = message["ECSAmis"][0]["Regions"][region]["ImageId"]
-        logger.info(f"The latest AMI id in {region} is {ami_id}")
-    except (KeyError, IndexError) as e:
-        print(f"Failed to retrieve AMI Id for {region} region from the event")
-        handle_exception(e)
-    try:
-        response = client.describe_stacks(StackName=stack_name)
-    except ClientError as e:
-        print(f"Error fetching {stack_name} Stack details")
+        store.record(key)
+    except Exception as e:
+        print(f"Error recording the update of {result['stack_name']} stack in {result['region']}")
         handle_exception(e)
+        result["idempotency_error"] = str(e)
+
 
-    parameters = []
+def update_target(target, ami_ids, store=None, change_set_mode=None):
+    """
+    Point the AMI id parameter of one stack to the new AMI of its region,
+    unless it already uses it. Return the result of the target.
+    """
+    result = {
+        "region": target["region"],
+        "stack_name": target["stack_name"],
+        "status": "failed",
+        "error": None,
+    }
+    store = store if store else idempotency.IdempotencyStore()
 
-    # copy all current parameters except ami id
+    ami_id = ami_ids.get(target["region"])
+    if ami_id is None:
+        # Nothing released for this region
+        result["status"] = "skipped"
+        result["error"] = f"No AMI id for {target['region']} region in the event"
+        return result
+    result["ami_id"] = ami_id
 
+    key = idempotency.record_key(target["region"], target["stack_name"], target["parameter_name"], ami_id)
+    # Created on the first use, then reused while the container is warm
+    client = clients.client("cloudformation", target["region"])
     try:
-        for parameter in response["Stacks"][0]["Parameters"]:
-            if parameter["ParameterKey"] == ami_id_parameter_name:
+        if store.seen(key):
+            # A re-delivery of a notification already handled
+            result["status"] = "duplicate"
+            return result
+
+        current = target.get("parameters")
+        if current is None:
+            response = client.describe_stacks(StackName=target["stack_name"])
+            current = response["Stacks"][0]["Parameters"]
+
+        previous_ami_id = parameter_value(current, target["parameter_name"])
+        if previous_ami_id is None:
+            raise KeyError(f"{target['stack_name']} has no {target['parameter_name']} parameter")
+        if previous_ami_id == ami_id:
+            result["status"] = "unchanged"
+            record_done(store, key, result)
+            return result
+        result["previous_ami_id"] = previous_ami_id
+
+        # copy all current parameters except ami id
+        parameters = []
+        for parameter in current:
+            if parameter["ParameterKey"] == target["parameter_name"]:
                 continue
             parameters.append(
                 {"ParameterKey": parameter["ParameterKey"], "UsePreviousValue": True}
             )
-    except (KeyError, IndexError) as e:
-        print(f"Failed to get current parameters of {stack_name} from stack details")
+        # replace the ami_id
+        parameters.append({"ParameterKey": target["parameter_name"], "ParameterValue": ami_id})
+
+        if change_set_mode:
+            replacements = run_change_set(client, target, parameters, ami_id, change_set_mode)
+            if replacements is None:
+                result["status"] = "unchanged"
+                record_done(store, key, result)
+                return result
+            result["replacements"] = replacements
+            if change_set_mode != "execute":
+                # Nothing changed yet, the next delivery is not a duplicate
+                result["status"] = "previewed"
+                return result
+        else:
+            # call update stack using current template and pass the above parameters
+            client.update_stack(
+                StackName=target["stack_name"],
+                UsePreviousTemplate=True,
+                Parameters=parameters,
+            )
+    except Exception as e:
+        if isinstance(e, ClientError) and no_changes(str(e)):
+            result["status"] = "unchanged"
+            record_done(store, key, result)
+            return result
+        print(f"Error updating {target['stack_name']} stack in {target['region']}")
         handle_exception(e)
-    # replace the ami_id
-    parameters.append({"ParameterKey": ami_id_parameter_name, "ParameterValue": ami_id})
+        result["error"] = str(e)
+        return result
+
+    result["status"] = "updated"
+    record_done(store, key, result)
+    return result
+
 
-    # call update stack using current template and pass the above parameters
+def get_idempotency_store():
+    global idempotency_store
+    if idempotency_store is None:
+        region = get_settings()["region"]
+        idempotency_store = idempotency.get_store(os.environ, lambda service: clients.client(service, region))
+    return idempotency_store
+
+
+def update_ami(event):
     try:
-        response = client.update_stack(
-            StackName=stack_name,
-            UsePreviousTemplate=True,
-            Parameters=parameters,
-        )
-    except ClientError as e:
-        print("Error initiating stack update")
+        ami_ids = get_ami_ids(event)
+    except (KeyError, IndexError, ValueError) as e:
+        print("Failed to retrieve the AMI ids from the event")
         handle_exception(e)
+        raise
+
+    settings = get_settings()
+    # Every worker can have a call in flight
+    clients.set_concurrency(settings["max_workers"])
+    targets, failures = get_targets()
+    logger.info(f"Updating {len(targets)} stacks")
+
+    store = get_idempotency_store()
+    workers = max(1, min(settings["max_workers"], len(targets)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda target: update_target(target, ami_ids, store, settings["change_set_mode"]),
+                targets,
+            )
+        )
+    # Regions discovery could not search come first
+    results = failures + results
+
+    failed = [result for result in results if result["status"] == "failed"]
+    for result in results:
+        logger.info(json.dumps(result))
+    if failed:
+        logger.error(f"{len(failed)} of {len(results)} stack updates failed")
+
+    summary = {"results": results, "failed": len(failed)}
+    for status in ("updated", "unchanged", "duplicate", "previewed", "skipped"):
+        summary[status] = len([result for result in results if result["status"] == status])
+    return summary
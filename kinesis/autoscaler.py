@@ -0,0 +1,351 @@
+"""
+Keep a Kinesis stream sized to its traffic. Every interval the per shard
+throughput is sampled and compared to the shard limits. A shard that
+stays hot for breach_periods samples is split and a pair of adjacent
+shards that stays cold is merged (or the whole stream is rescaled with
+update_shard_count in uniform mode). No action is taken during the
+cooldown that follows a reshard.
+"""
+from resharding import KinesisClient, read_partition_key_samples
+# resharding puts aws_common on the path
+from aws_common import clients, instrumentation, throttling
+from datetime import datetime, timedelta
+import argparse
+import logging
+import json
+import math
+import time
+import attr
+
+logger = logging.getLogger('kinesis.autoscaler')
+
+# Write limits of a single shard
+SHARD_BYTES_PER_SECOND = 1048576
+SHARD_RECORDS_PER_SECOND = 1000
+
+# get_metric_data accepts up to 500 queries per call, two per shard
+SHARDS_PER_METRICS_CALL = 250
+
+
+@attr.s
+class CloudWatchMetrics(object):
+    """
+    Per shard IncomingBytes and IncomingRecords rates from CloudWatch.
+    Needs the shard level (enhanced) metrics enabled on the stream.
+    """
+    stream = attr.ib()
+    region = attr.ib(default='us-east-1')
+    period = attr.ib(default=60)
+    aws_secret_access_key = attr.ib(default=None)
+    aws_access_key_id = attr.ib(default=None)
+    calls = attr.ib(default=0)
+
+    conn = attr.ib()
+
+    @conn.default
+    def init_conn(self):
+        return clients.client('cloudwatch', self.region, aws_access_key_id=self.aws_access_key_id,
+                              aws_secret_access_key=self.aws_secret_access_key)
+
+    def _query(self, query_id, metric_name, shard_id):
+        return {'Id': query_id,
+                'MetricStat': {'Metric': {'Namespace': 'AWS/Kinesis',
+                                          'MetricName': metric_name,
+                                          'Dimensions': [{'Name': 'StreamName', 'Value': self.stream},
+                                                         {'Name': 'ShardId', 'Value': shard_id}]},
+                               'Period': self.period,
+                               'Stat': 'Sum'},
+                'ReturnData': True}
+
+    def shard_metrics(self, shard_ids):
+        """
+        Return {shard_id: {incoming_bytes: per second, incoming_records: per second}}
+        from the latest complete period
+        """
+        # The period in progress would under-report the load, the window
+        # ends at the last period boundary
+        now = time.time()
+        end = datetime.utcfromtimestamp(now - now % self.period)
+        start = end - timedelta(seconds=self.period * 5)
+        metrics = dict((shard_id, {'incoming_bytes': 0.0, 'incoming_records': 0.0}) for shard_id in shard_ids)
+
+        shard_ids = list(shard_ids)
+        for i in range(0, len(shard_ids), SHARDS_PER_METRICS_CALL):
+            queries = []
+            names = {}
+            for j, shard_id in enumerate(shard_ids[i:i + SHARDS_PER_METRICS_CALL]):
+                for prefix, metric_name, key in (('b', 'IncomingBytes', 'incoming_bytes'),
+                                                 ('r', 'IncomingRecords', 'incoming_records')):
+                    query_id = "{0}{1}".format(prefix, j)
+                    names[query_id] = (shard_id, key)
+                    queries.append(self._query(query_id, metric_name, shard_id))
+
+            kwargs = {'MetricDataQueries': queries, 'StartTime': start, 'EndTime': end, 'ScanBy': 'TimestampDescending'}
+            while True:
+                self.calls += 1
+                response = self.conn.get_metric_data(**kwargs)
+                for result in response['MetricDataResults']:
+                    if result['Values']:
+                        shard_id, key = names[result['Id']]
+                        metrics[shard_id][key] = result['Values'][0] / float(self.period)
+                if 'NextToken' not in response:
+                    break
+                kwargs['NextToken'] = response['NextToken']
+
+        return metrics
+
+
+@attr.s
+class FileMetrics(object):
+    """
+    Per shard rates read from a JSON file on every sample.
+    syntax: {shard_id: {incoming_bytes: per second, incoming_records: per second}}
+    """
+    path = attr.ib()
+
+    def shard_metrics(self, shard_ids):
+        with open(self.path) as f:
+            data = json.load(f)
+        return dict((shard_id, data.get(shard_id, {})) for shard_id in shard_ids)
+
+
+@attr.s
+class Autoscaler(object):
+    client = attr.ib()
+    metrics = attr.ib()
+    scale_up_threshold = attr.ib(default=0.8)
+    scale_down_threshold = attr.ib(default=0.3)
+    breach_periods = attr.ib(default=3)
+    cooldown = attr.ib(default=300)
+    mode = attr.ib(default='targeted')
+    min_shards = attr.ib(default=1)
+    max_shards = attr.ib(default=500)
+    dry_run = attr.ib(default=False)
+    clock = attr.ib(default=time.time)
+    sleep = attr.ib(default=time.sleep)
+    # Rewritten with the API call and stage timings after every sample
+    report_path = attr.ib(default=None)
+
+    # Consecutive breaching samples per shard, pair of shards or direction
+    hot = attr.ib(default=attr.Factory(dict))
+    cold = attr.ib(default=attr.Factory(dict))
+    last_action = attr.ib(default=None)
+    stats = attr.ib(default=attr.Factory(dict))
+
+    def _count(self, key, value=1):
+        self.stats[key] = self.stats.get(key, 0) + value
+        instrumentation.add("autoscaler_{0}".format(key), value)
+
+    def utilization(self, shard_metrics):
+        """
+        Return {shard_id: fraction of the shard write limit used}
+        """
+        return dict((shard_id, max(values.get('incoming_bytes', 0) / float(SHARD_BYTES_PER_SECOND),
+                                   values.get('incoming_records', 0) / float(SHARD_RECORDS_PER_SECOND)))
+                    for shard_id, values in shard_metrics.items())
+
+    def _streaks(self, streaks, breaching):
+        """
+        Keep counting the keys that are still breaching, forget the others
+        """
+        counts = dict((key, streaks.get(key, 0) + 1) for key in breaching)
+        streaks.clear()
+        streaks.update(counts)
+
+    def decide(self, index, utilization):
+        """
+        Update the breach streaks and return the operations to run.
+        syntax: [('split', shard_id) | ('merge', shard_id, adjacent_shard_id) | ('update', count)]
+        """
+        if self.mode == 'uniform':
+            total = sum(utilization.values())
+            target = (self.scale_up_threshold + self.scale_down_threshold) / 2.0
+            wanted = int(math.ceil(total / target)) if total else self.min_shards
+            # update_shard_count can at most double or halve the stream
+            wanted = max(self.min_shards, min(self.max_shards, len(index) * 2, wanted))
+            wanted = max(wanted, (len(index) + 1) // 2)
+
+            hot = any(value > self.scale_up_threshold for value in utilization.values())
+            cold = max(utilization.values() or [0]) < self.scale_down_threshold
+            direction = 'up' if hot and wanted > len(index) else 'down' if cold and wanted < len(index) else None
+            self._streaks(self.hot, [direction] if direction else [])
+            if direction and self.hot[direction] >= self.breach_periods:
+                return [('update', wanted)]
+            return []
+
+        self._streaks(self.hot, [shard_id for shard_id, value in utilization.items() if value > self.scale_up_threshold])
+
+        # Only shards next to each other in the hash key space can be merged
+        pairs = []
+        for i in range(1, len(index)):
+            if index.ends[i - 1] + 1 == index.starts[i]:
+                lower, upper = index.shard_ids[i - 1], index.shard_ids[i]
+                if utilization.get(lower, 0) + utilization.get(upper, 0) < self.scale_down_threshold:
+                    pairs.append((lower, upper))
+        self._streaks(self.cold, pairs)
+
+        if len(index) < self.max_shards:
+            hot = [shard_id for shard_id, count in self.hot.items() if count >= self.breach_periods]
+            if hot:
+                return [('split', max(hot, key=lambda shard_id: utilization[shard_id]))]
+
+        if len(index) > self.min_shards:
+            cold = [pair for pair, count in self.cold.items() if count >= self.breach_periods]
+            if cold:
+                return [('merge',) + min(cold, key=lambda pair: utilization.get(pair[0], 0) + utilization.get(pair[1], 0))]
+
+        return []
+
+    def _run_operation(self, operation):
+        if operation[0] == 'split':
+            return self.client.split_shard(operation[1])
+        if operation[0] == 'merge':
+            return self.client.merge_shards(operation[1], operation[2])
+        return self.client.update_shard_count(operation[1])
+
+    def step(self):
+        """
+        Sample the metrics once and reshard if needed.
+        Return the operations done.
+        """
+        start = self.clock()
+        index = self.client.get_shard_index()
+
+        metrics_start = time.time()
+        with instrumentation.span('autoscaler_metrics'):
+            utilization = self.utilization(self.metrics.shard_metrics(index.shard_ids))
+        self._count('metrics_samples')
+        self._count('metrics_seconds', time.time() - metrics_start)
+
+        operations = self.decide(index, utilization)
+        logger.info("%s: %d shards, utilization max %.2f mean %.2f, hot %d, cold pairs %d",
+                    self.client.name, len(index), max(utilization.values() or [0]),
+                    sum(utilization.values()) / max(len(utilization), 1),
+                    len(self.hot), len(self.cold))
+
+        if operations and self.last_action is not None and start - self.last_action < self.cooldown:
+            logger.info("%s: in cooldown for %.0fs, skipping %s", self.client.name,
+                        self.cooldown - (start - self.last_action), operations)
+            self._count('skipped_cooldown')
+            return []
+
+        done = []
+        for operation in operations:
+            logger.info("%s: decided %s", self.client.name, operation)
+            if self.dry_run:
+                continue
+
+            operation_start = time.time()
+            ok = self._run_operation(operation)
+            elapsed = time.time() - operation_start
+            self._count("{0}_seconds".format(operation[0]), elapsed)
+            if not ok:
+                logger.warning("%s: %s failed after %.1fs", self.client.name, operation, elapsed)
+                self._count("{0}_failed".format(operation[0]))
+                continue
+
+            logger.info("%s: %s done in %.1fs", self.client.name, operation, elapsed)
+            self._count(operation[0])
+            done.append(operation)
+
+        if done:
+            self.last_action = self.clock()
+            # The shard ids changed, start counting again
+            self.hot.clear()
+            self.cold.clear()
+            self.client.get_shard_details()
+
+        return done
+
+    def run(self, interval=60, iterations=None):
+        """
+        Call step every interval seconds, forever or for iterations steps
+        """
+        i = 0
+        while iterations is None or i < iterations:
+            i += 1
+            try:
+                with instrumentation.span('autoscaler_step'):
+                    self.step()
+            except Exception:
+                logger.exception("%s: autoscaling step failed", self.client.name)
+                self._count('errors')
+            logger.info("%s: stats %s", self.client.name, json.dumps(self.stats, sort_keys=True))
+            if self.report_path:
+                instrumentation.DEFAULT_RECORDER.write(self.report_path)
+            self.sleep(interval)
+
+
+class SimulatedClock(object):
+    """
+    Clock advanced by sleep, to run the daemon against fakes without waiting
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Autoscale a Kinesis stream from its shard level metrics')
+    parser.add_argument('--stream', '-s', dest='stream', default=None, help='Kinesis stream name, required unless --simulate is given')
+    parser.add_argument('--region', '-r', dest='region', default='us-east-1', help='AWS region')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None, help='Read per shard rates from this JSON file instead of CloudWatch')
+    parser.add_argument('--scale-up', dest='scale_up', type=float, default=0.8, help='Split shards above this fraction of the shard limits')
+    parser.add_argument('--scale-down', dest='scale_down', type=float, default=0.3, help='Merge adjacent shards using together less than this fraction of the shard limits')
+    parser.add_argument('--breach-periods', dest='breach_periods', type=int, default=3, help='Consecutive samples a threshold has to be breached before acting')
+    parser.add_argument('--cooldown', dest='cooldown', type=int, default=300, help='Seconds to wait after a reshard before the next one')
+    parser.add_argument('--interval', dest='interval', type=int, default=60, help='Seconds between samples, a multiple of 60 with CloudWatch metrics')
+    parser.add_argument('--iterations', dest='iterations', type=int, default=None, help='Stop after this many samples')
+    parser.add_argument('--mode', dest='mode', choices=['targeted', 'uniform'], default='targeted', help='Split/merge single shards or rescale the whole stream with update_shard_count')
+    parser.add_argument('--min-shards', dest='min_shards', type=int, default=1, help='Minimum number of open shards')
+    parser.add_argument('--max-shards', dest='max_shards', type=int, default=500, help='Maximum number of open shards')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Only log the decisions')
+    parser.add_argument('--simulate', dest='simulate', type=int, default=None, help='Run against a fake stream with this many shards, on a simulated clock')
+    parser.add_argument('--samples', dest='samples', default=None, help='With --simulate, partition key samples (key<TAB>bytes per second) driving the fake metrics')
+    parser.add_argument('--load-scale', dest='load_scale', type=float, default=1.0, help='With --simulate, multiply the sampled load by this factor')
+    parser.add_argument('--metrics', dest='metrics', default=None, help='Rewrite the API call and stage timings to this file after every sample, as JSON for .json files and as Prometheus text otherwise')
+    args = parser.parse_args()
+    if args.simulate and not args.samples:
+        parser.error('--simulate needs --samples to drive the fake metrics')
+    if not args.simulate and not args.stream:
+        parser.error('--stream is required unless --simulate is given')
+    if not args.simulate and not args.metrics_file and (args.interval <= 0 or args.interval % 60):
+        # Also the CloudWatch period, which has to be a multiple of 60 seconds
+        parser.error('--interval has to be a multiple of 60 with CloudWatch metrics')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    options = {'scale_up_threshold': args.scale_up, 'scale_down_threshold': args.scale_down,
+               'breach_periods': args.breach_periods, 'cooldown': args.cooldown, 'mode': args.mode,
+               'min_shards': args.min_shards, 'max_shards': args.max_shards, 'dry_run': args.dry_run,
+               'report_path': args.metrics}
+
+    if args.simulate:
+        from fake_kinesis import SampleLoadMetrics, fake_client
+
+        client = fake_client(args.stream or 'fake-stream', shards=args.simulate, update_polls=1)
+        with open(args.samples) as f:
+            metrics = SampleLoadMetrics(client, read_partition_key_samples(f), scale=args.load_scale)
+        clock = SimulatedClock()
+        options.update(clock=clock, sleep=clock.sleep)
+    else:
+        client = KinesisClient(args.stream, region=args.region)
+        if args.metrics_file:
+            metrics = FileMetrics(args.metrics_file)
+        else:
+            metrics = CloudWatchMetrics(args.stream, region=args.region, period=args.interval)
+
+    client.get_shard_details()
+    autoscaler = Autoscaler(client, metrics, **options)
+    autoscaler.run(interval=args.interval, iterations=args.iterations)
+
+    if args.simulate:
+        print("Open shards: {}\nAPI calls: {}".format(client.get_shard_count(), client.conn.client.calls))
+        print(throttling.DEFAULT_THROTTLER.report())
+        print(instrumentation.DEFAULT_RECORDER.summary())
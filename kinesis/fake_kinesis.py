@@ -0,0 +1,238 @@
+"""
+Offline stand-ins for the Kinesis client and the shard metrics sources,
+for running the resharding and autoscaling code without an AWS account.
+Only the calls and response fields KinesisClient uses are implemented.
+"""
+from botocore.exceptions import ClientError
+from resharding import MAX_HASH_KEY, KinesisClient
+# resharding puts aws_common on the path
+from aws_common import throttling
+from threading import RLock
+import random
+import attr
+
+
+def _error(name, code):
+    def __init__(self, message='', operation='Kinesis'):
+        ClientError.__init__(self, {'Error': {'Code': code, 'Message': message}}, operation)
+    return type(name, (ClientError,), {'__init__': __init__})
+
+
+class FakeExceptions(object):
+    ResourceInUseException = _error('ResourceInUseException', 'ResourceInUseException')
+    LimitExceededException = _error('LimitExceededException', 'LimitExceededException')
+    ExpiredNextTokenException = _error('ExpiredNextTokenException', 'ExpiredNextTokenException')
+    InvalidArgumentException = _error('InvalidArgumentException', 'InvalidArgumentException')
+
+
+class FakeKinesis(object):
+    """
+    A single stream whose shards split and merge like Kinesis ones. After
+    every reshard the stream stays UPDATING for update_polls
+    describe_stream calls.
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, shards=1, update_polls=2, page_size=100, lock=None):
+        self.shards = []
+        self.next_shard = 0
+        self.update_polls = update_polls
+        self.updating = 0
+        self.page_size = page_size
+        self.calls = {}
+        # Several fake streams can share a lock to serialise their calls
+        self.lock = lock if lock else RLock()
+        for i in range(shards):
+            self._add_shard(i * (MAX_HASH_KEY + 1) // shards, (i + 1) * (MAX_HASH_KEY + 1) // shards - 1)
+
+    def _call(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _add_shard(self, start, end):
+        self.shards.append({'ShardId': "shardId-{0:012d}".format(self.next_shard),
+                            'HashKeyRange': {'StartingHashKey': str(start), 'EndingHashKey': str(end)},
+                            'SequenceNumberRange': {'StartingSequenceNumber': '0'}})
+        self.next_shard += 1
+
+    def _open_shard(self, shard_id):
+        for shard in self.shards:
+            if shard['ShardId'] == shard_id and 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                return shard
+        raise self.exceptions.InvalidArgumentException("Shard {0} is not an open shard".format(shard_id))
+
+    def _close(self, shard):
+        shard['SequenceNumberRange']['EndingSequenceNumber'] = '1'
+        return int(shard['HashKeyRange']['StartingHashKey']), int(shard['HashKeyRange']['EndingHashKey'])
+
+    def _start_update(self):
+        if self.updating:
+            raise self.exceptions.ResourceInUseException('Stream is being updated')
+        self.updating = self.update_polls
+
+    def open_shard_count(self):
+        return len([shard for shard in self.shards if 'EndingSequenceNumber' not in shard['SequenceNumberRange']])
+
+    def list_shards(self, StreamName=None, NextToken=None, ExclusiveStartShardId=None):
+        self._call('ListShards')
+        with self.lock:
+            start = int(NextToken) if NextToken else 0
+            if ExclusiveStartShardId:
+                start = len([shard for shard in self.shards if shard['ShardId'] <= ExclusiveStartShardId])
+            end = start + self.page_size
+            response = {'Shards': [dict(shard, SequenceNumberRange=dict(shard['SequenceNumberRange'])) for shard in self.shards[start:end]]}
+            if end < len(self.shards):
+                response['NextToken'] = str(end)
+        return response
+
+    def describe_stream(self, StreamName, Limit=None):
+        self._call('DescribeStream')
+        with self.lock:
+            status = 'UPDATING' if self.updating else 'ACTIVE'
+            self.updating = max(self.updating - 1, 0)
+        return {'StreamDescription': {'StreamName': StreamName, 'StreamStatus': status}}
+
+    def split_shard(self, StreamName, ShardToSplit, NewStartingHashKey):
+        self._call('SplitShard')
+        with self.lock:
+            shard = self._open_shard(ShardToSplit)
+            key = int(NewStartingHashKey)
+            start, end = int(shard['HashKeyRange']['StartingHashKey']), int(shard['HashKeyRange']['EndingHashKey'])
+            if not start < key <= end:
+                raise self.exceptions.InvalidArgumentException("{0} is outside of {1}".format(key, ShardToSplit))
+            self._start_update()
+            self._close(shard)
+            self._add_shard(start, key - 1)
+            self._add_shard(key, end)
+        return {}
+
+    def merge_shards(self, StreamName, ShardToMerge, AdjacentShardToMerge):
+        self._call('MergeShards')
+        with self.lock:
+            lower = self._open_shard(ShardToMerge)
+            upper = self._open_shard(AdjacentShardToMerge)
+            if int(lower['HashKeyRange']['EndingHashKey']) + 1 != int(upper['HashKeyRange']['StartingHashKey']):
+                raise self.exceptions.InvalidArgumentException("{0} and {1} are not adjacent".format(ShardToMerge, AdjacentShardToMerge))
+            self._start_update()
+            start, _ = self._close(lower)
+            _, end = self._close(upper)
+            self._add_shard(start, end)
+        return {}
+
+    def update_shard_count(self, StreamName, TargetShardCount, ScalingType):
+        self._call('UpdateShardCount')
+        with self.lock:
+            current = self.open_shard_count()
+            if TargetShardCount > current * 2 or TargetShardCount * 2 < current:
+                raise self.exceptions.LimitExceededException('Can only double or halve the shard count')
+            self._start_update()
+            for shard in self.shards:
+                if 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                    self._close(shard)
+            for i in range(TargetShardCount):
+                self._add_shard(i * (MAX_HASH_KEY + 1) // TargetShardCount, (i + 1) * (MAX_HASH_KEY + 1) // TargetShardCount - 1)
+        return {'StreamName': StreamName, 'CurrentShardCount': current, 'TargetShardCount': TargetShardCount}
+
+
+class FakeKinesisAccount(object):
+    """
+    Several FakeKinesis streams sharing an account shard limit. Reshards
+    that would go over the limit, and a limit_rate share of all reshard
+    calls, fail with LimitExceededException.
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, streams, shard_limit=500, limit_rate=0.0, update_polls=2, seed=None):
+        """
+        streams: {stream_name: shard count}
+        """
+        self.lock = RLock()
+        self.shard_limit = shard_limit
+        self.limit_rate = limit_rate
+        self.random = random.Random(seed)
+        self.streams = dict((name, FakeKinesis(shards=shards, update_polls=update_polls, lock=self.lock))
+                            for name, shards in streams.items())
+        self.open_shards_peak = self.open_shard_count()
+
+    @property
+    def calls(self):
+        calls = {}
+        for stream in self.streams.values():
+            for operation, count in stream.calls.items():
+                calls[operation] = calls.get(operation, 0) + count
+        return calls
+
+    def open_shard_count(self):
+        return sum(stream.open_shard_count() for stream in self.streams.values())
+
+    def _check_limit(self, added):
+        if self.limit_rate and self.random.random() < self.limit_rate:
+            raise self.exceptions.LimitExceededException('Rate exceeded')
+        if self.open_shard_count() + added > self.shard_limit:
+            raise self.exceptions.LimitExceededException("Shard limit of {0} exceeded".format(self.shard_limit))
+
+    def _reshard(self, StreamName, added, method, **kwargs):
+        with self.lock:
+            self._check_limit(added)
+            response = getattr(self.streams[StreamName], method)(StreamName=StreamName, **kwargs)
+            self.open_shards_peak = max(self.open_shards_peak, self.open_shard_count())
+        return response
+
+    def describe_limits(self):
+        with self.lock:
+            return {'ShardLimit': self.shard_limit, 'OpenShardCount': self.open_shard_count()}
+
+    def list_streams(self, ExclusiveStartStreamName=None, Limit=100):
+        names = sorted(name for name in self.streams if not ExclusiveStartStreamName or name > ExclusiveStartStreamName)
+        return {'StreamNames': names[:Limit], 'HasMoreStreams': len(names) > Limit}
+
+    def list_shards(self, StreamName=None, NextToken=None, ExclusiveStartShardId=None):
+        # The stream name travels in the token, like in the real API
+        if NextToken:
+            StreamName, NextToken = NextToken.split('|')
+        response = self.streams[StreamName].list_shards(NextToken=NextToken, ExclusiveStartShardId=ExclusiveStartShardId)
+        if 'NextToken' in response:
+            response['NextToken'] = "{0}|{1}".format(StreamName, response['NextToken'])
+        return response
+
+    def describe_stream(self, StreamName, Limit=None):
+        return self.streams[StreamName].describe_stream(StreamName=StreamName, Limit=Limit)
+
+    def split_shard(self, StreamName, ShardToSplit, NewStartingHashKey):
+        return self._reshard(StreamName, 1, 'split_shard', ShardToSplit=ShardToSplit, NewStartingHashKey=NewStartingHashKey)
+
+    def merge_shards(self, StreamName, ShardToMerge, AdjacentShardToMerge):
+        return self._reshard(StreamName, 0, 'merge_shards', ShardToMerge=ShardToMerge, AdjacentShardToMerge=AdjacentShardToMerge)
+
+    def update_shard_count(self, StreamName, TargetShardCount, ScalingType):
+        added = max(TargetShardCount - self.streams[StreamName].open_shard_count(), 0)
+        return self._reshard(StreamName, added, 'update_shard_count', TargetShardCount=TargetShardCount, ScalingType=ScalingType)
+
+
+@attr.s
+class SampleLoadMetrics(object):
+    """
+    Metrics source deriving per shard throughput from (hash_key,
+    bytes_per_second) samples, so the load follows the shards as they
+    split and merge. records_per_byte turns bytes into records.
+    """
+    client = attr.ib()
+    samples = attr.ib()
+    scale = attr.ib(default=1.0)
+    records_per_byte = attr.ib(default=0.001)
+
+    def shard_metrics(self, shard_ids):
+        load = self.client.shard_load(self.samples)
+        metrics = {}
+        for shard_id in shard_ids:
+            incoming_bytes = self.scale * sum(weight for hash_key, weight in load.get(shard_id, []))
+            metrics[shard_id] = {'incoming_bytes': incoming_bytes,
+                                 'incoming_records': incoming_bytes * self.records_per_byte}
+        return metrics
+
+
+def fake_client(name='fake-stream', shards=1, **kwargs):
+    """
+    Return a KinesisClient connected to a FakeKinesis stream, through
+    the throttling layer like a real client
+    """
+    return KinesisClient(name, conn=throttling.install(FakeKinesis(shards=shards, **kwargs), 'kinesis'))
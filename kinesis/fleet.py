@@ -0,0 +1,225 @@
+"""
+Reshard many Kinesis streams of a region at once. Streams are processed
+concurrently on a worker pool, one operation at a time per stream (Kinesis
+rejects concurrent reshards of a stream), and shards are reserved from the
+account shard limit before every scale up so streams queue instead of
+failing when the limit would be exceeded.
+"""
+from resharding import KinesisClient
+# resharding puts aws_common on the path
+from aws_common import clients, instrumentation, throttling
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+import traceback
+import argparse
+import math
+import sys
+import time
+
+DEBUG = False
+
+# Seconds a stream waits for free shards under the account limit
+MAX_QUEUE_WAIT = 1800
+
+
+class ShardBudget(object):
+    """
+    Shards still available under the account shard limit, shared by the
+    workers
+    """
+
+    def __init__(self, available):
+        self.available = available
+        self.condition = Condition()
+
+    def acquire(self, shards, timeout=MAX_QUEUE_WAIT):
+        """
+        Wait until shards can be reserved. Return False on timeout.
+        """
+        deadline = time.time() + timeout
+        with instrumentation.span('shard_budget_wait'), self.condition:
+            while self.available < shards:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.available -= shards
+            return True
+
+    def release(self, shards):
+        with self.condition:
+            self.available += shards
+            self.condition.notify_all()
+
+
+def list_streams(conn):
+    """
+    Return the names of all the streams of the region
+    """
+    names = []
+    kwargs = {}
+    while True:
+        response = conn.list_streams(**kwargs)
+        names.extend(response['StreamNames'])
+        if not response['HasMoreStreams'] or not response['StreamNames']:
+            break
+        kwargs['ExclusiveStartStreamName'] = response['StreamNames'][-1]
+    return names
+
+
+def account_budget(conn, shard_limit=None):
+    """
+    Return a ShardBudget with the shards left under the account limit
+    """
+    limits = conn.describe_limits()
+    return ShardBudget((shard_limit or limits['ShardLimit']) - limits['OpenShardCount'])
+
+
+def _update_steps(current, target):
+    """
+    update_shard_count can at most double or halve a stream per call
+    """
+    steps = []
+    while current != target:
+        if target > current:
+            current = min(target, current * 2)
+        else:
+            current = max(target, int(math.ceil(current / 2.0)))
+        steps.append(current)
+    return steps
+
+
+def reshard_stream(client, target, budget, mode='update', queue_wait=MAX_QUEUE_WAIT):
+    """
+    Reshard one stream to target shards, with update_shard_count steps or
+    with a split/merge plan. Return a summary dict.
+    """
+    start = time.time()
+    summary = {'stream': client.name, 'before': None, 'after': None, 'target': target,
+               'operations': 0, 'error': None}
+    try:
+        summary['before'] = current = client.get_shard_count(refresh=True)
+
+        if mode == 'update':
+            for count in _update_steps(current, target):
+                added = max(count - current, 0)
+                if not budget.acquire(added, queue_wait):
+                    raise Exception("No room under the account shard limit for {} more shards".format(added))
+                if not client.update_shard_count(count):
+                    budget.release(added)
+                    raise Exception("update_shard_count to {} failed".format(count))
+                budget.release(max(current - count, 0))
+                current = count
+                summary['operations'] += 1
+        else:
+            for action, key in client.plan_reshard(target) or []:
+                added = 1 if action == 'split' else 0
+                if not budget.acquire(added, queue_wait):
+                    raise Exception("No room under the account shard limit for a split")
+                if not client.run_reshard_operation(action, key):
+                    budget.release(added)
+                    raise Exception("{} at {} failed".format(action, key))
+                budget.release(1 if action == 'merge' else 0)
+                summary['operations'] += 1
+
+        summary['after'] = client.get_shard_count(refresh=True)
+    except Exception as e:
+        if DEBUG:
+            traceback.print_exc()
+        summary['error'] = "{0}".format(e)
+
+    summary['elapsed'] = time.time() - start
+    return summary
+
+
+def reshard_fleet(conn, targets, budget, workers=8, mode='update', queue_wait=MAX_QUEUE_WAIT):
+    """
+    targets: {stream_name: shard count}
+    Return the stream summaries
+    """
+    # boto3 clients are thread safe, all the streams share one
+    clients = [KinesisClient(name, conn=conn) for name in sorted(targets)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reshard_stream, client, targets[client.name], budget, mode, queue_wait) for client in clients]
+        summaries = [future.result() for future in futures]
+
+    for summary in summaries:
+        instrumentation.add('streams_failed' if summary['error'] else 'streams_resharded')
+        instrumentation.add('reshard_operations', summary['operations'])
+    return summaries
+
+
+def print_report(summaries, elapsed):
+    columns = ['stream', 'before', 'target', 'after', 'operations', 'elapsed', 'error']
+    print("\t".join(columns))
+    for summary in summaries:
+        row = dict(summary, elapsed="{0:.1f}".format(summary['elapsed']), error=summary['error'] or '')
+        print("\t".join("{0}".format(row[column]) for column in columns))
+
+    print('TOTAL')
+    print('=====')
+    print("Streams: {0}\nFailed streams: {1}".format(len(summaries), len([s for s in summaries if s['error']])))
+    print("Operations: {0}".format(sum(s['operations'] for s in summaries)))
+    print("Elapsed: {0:.1f}s".format(elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reshard many Kinesis streams of a region concurrently')
+    parser.add_argument('--access-key-id', '-a', dest='access_key_id', required=False, default=None, help='AWS Access Key Id')
+    parser.add_argument('--secret-access-key', '-k', dest='secret_access_key', required=False, default=None, help='AWS Secret Access Key')
+    parser.add_argument('--region', '-r', dest='region', default='us-east-1', help='AWS region')
+    parser.add_argument('--stream', '-s', dest='streams', action='append', default=[], help='STREAM=COUNT target, can be repeated')
+    parser.add_argument('--scale', dest='scale', type=float, default=None, help='Multiply the shard count of every stream (or of the --prefix ones) by this factor')
+    parser.add_argument('--prefix', dest='prefix', default='', help='With --scale, only the streams starting with this prefix')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=8, help='Number of streams resharded in parallel')
+    parser.add_argument('--mode', dest='mode', choices=['update', 'plan'], default='update', help='Use update_shard_count (fast, uniform) or a minimal split/merge plan')
+    parser.add_argument('--shard-limit', dest='shard_limit', type=int, default=None, help='Account shard limit. Defaults to the one from describe_limits')
+    parser.add_argument('--queue-wait', dest='queue_wait', type=int, default=MAX_QUEUE_WAIT, help='Seconds a stream waits for room under the account shard limit before failing')
+    parser.add_argument('--simulate', dest='simulate', type=int, default=None, help='Run against this many fake streams of 4 to 16 shards')
+    parser.add_argument('--metrics', dest='metrics', default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
+    args = parser.parse_args()
+
+    stream_targets = {}
+    for target in args.streams:
+        name, _, count = target.partition('=')
+        if not name or not count.isdigit() or int(count) < 1:
+            parser.error("--stream {0}: expected STREAM=COUNT with a positive COUNT".format(target))
+        stream_targets[name] = int(count)
+
+    if args.simulate:
+        from fake_kinesis import FakeKinesisAccount
+
+        conn = FakeKinesisAccount(dict(("stream-{0:03d}".format(i), 4 + i % 13) for i in range(args.simulate)),
+                                  shard_limit=args.shard_limit or 500, limit_rate=0.05, update_polls=1, seed=0)
+        account = conn
+        conn = throttling.install(conn, 'kinesis', args.region)
+    else:
+        # Every worker can have a call in flight
+        clients.set_concurrency(args.workers)
+        conn = clients.client('kinesis', args.region, aws_access_key_id=args.access_key_id,
+                              aws_secret_access_key=args.secret_access_key)
+
+    targets = {}
+    if args.scale:
+        for name in list_streams(conn):
+            if name.startswith(args.prefix):
+                current = KinesisClient(name, conn=conn).get_shard_count(refresh=True)
+                targets[name] = max(1, int(math.ceil(current * args.scale)))
+    targets.update(stream_targets)
+
+    start = time.time()
+    budget = account_budget(conn, args.shard_limit)
+    print("{0} shards available under the account limit".format(budget.available))
+    summaries = reshard_fleet(conn, targets, budget, workers=args.workers, mode=args.mode, queue_wait=args.queue_wait)
+    print_report(summaries, time.time() - start)
+
+    if args.simulate:
+        print("Peak open shards: {0}\nAPI calls: {1}".format(account.open_shards_peak, account.calls))
+    print(throttling.DEFAULT_THROTTLER.report())
+    print(instrumentation.DEFAULT_RECORDER.summary())
+
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)
+
+    if any(summary['error'] for summary in summaries):
+        sys.exit(1)
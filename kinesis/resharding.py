@@ -1,9 +1,71 @@
 import attr
-import boto3
+import hashlib
+import heapq
+import math
+from bisect import bisect_right
 from botocore.exceptions import ClientError
 from time import sleep
+import os
+import sys
 
-MAX_RETRIES = 30
+# aws_common is shared by all the tools and lives at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aws_common import clients, instrumentation
+
+MAX_HASH_KEY = 2 ** 128 - 1
+
+# Waits for the stream to become ACTIVE again back off exponentially
+WAIT_INITIAL_DELAY = 0.5
+WAIT_MAX_DELAY = 8
+MAX_WAIT = 600
+
+# Rough duration of a single split or merge, for plan estimates
+SECONDS_PER_OPERATION = 30
+
+def partition_key_hash(partition_key):
+    """
+    Kinesis maps a partition key to the 128 bit integer value of its MD5 digest
+    """
+    if not isinstance(partition_key, bytes):
+        partition_key = partition_key.encode('utf-8')
+    return int.from_bytes(hashlib.md5(partition_key).digest(), 'big')
+
+def hash_partition_keys(keys):
+    """
+    Return the hash keys of many partition keys
+    """
+    md5 = hashlib.md5
+    from_bytes = int.from_bytes
+    return [from_bytes(md5(key if isinstance(key, bytes) else key.encode('utf-8')).digest(), 'big') for key in keys]
+
+def read_partition_key_samples(lines):
+    """
+    Parse sampled partition keys, one per line, optionally followed by a
+    tab and the number of bytes written with that key. Lines with an
+    invalid byte count are reported and skipped.
+    Return a list of (hash_key, weight) tuples.
+    """
+    keys = []
+    weights = []
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        key, sep, size = line.rpartition('\t')
+        if sep:
+            try:
+                weight = int(size)
+                if weight < 0:
+                    raise ValueError(size)
+            except ValueError:
+                print("Skipping sample line {0}, invalid byte count: {1!r}".format(number, line))
+                continue
+            keys.append(key)
+            weights.append(weight)
+        else:
+            keys.append(line)
+            weights.append(1)
+    return list(zip(hash_partition_keys(keys), weights))
 
 # Decorators
 def validate_conn(func):
@@ -20,24 +82,109 @@ def validate_conn(func):
 
 def handle_exceptions(func):
     """
-    Catch common errors
+    Catch common errors. Throttled calls (including
+    LimitExceededException) were already retried by aws_common.throttling.
     """
     def func_wrapper(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
         except ClientError as e:
-            print("CONNECTION ERROR.")
-            print("{}".format(e))
-            return None
-        except self.conn.exceptions.LimitExceededException as e:
-            # TODO - Catch self.conn.exceptions.LimitExceededException and 
-            # implement an exponential backoff
-            print("Please check stream limits")
+            # Modeled exceptions like LimitExceededException are ClientErrors
+            if e.response.get('Error', {}).get('Code') == 'LimitExceededException':
+                print("Please check stream limits")
+            else:
+                print("CONNECTION ERROR.")
             print("{}".format(e))
             return None
     return func_wrapper
 
 
+@attr.s
+class ShardIndex(object):
+    """
+    Sorted hash key intervals of the open shards of a stream, for
+    mapping hash keys to shards with bisect.
+    """
+    starts = attr.ib(default=attr.Factory(list))
+    ends = attr.ib(default=attr.Factory(list))
+    shard_ids = attr.ib(default=attr.Factory(list))
+    closed_shard_ids = attr.ib(default=attr.Factory(list))
+
+    @classmethod
+    def from_shard_details(cls, shard_details_dict):
+        intervals = []
+        closed_shard_ids = []
+        for shard_id, details in shard_details_dict.items():
+            if details.get('is_open', True):
+                intervals.append((int(details['starting_hash_key']), int(details['ending_hash_key']), shard_id))
+            else:
+                closed_shard_ids.append(shard_id)
+        intervals.sort()
+
+        return cls(starts=[start for start, end, shard_id in intervals],
+                   ends=[end for start, end, shard_id in intervals],
+                   shard_ids=[shard_id for start, end, shard_id in intervals],
+                   closed_shard_ids=sorted(closed_shard_ids))
+
+    def __len__(self):
+        return len(self.shard_ids)
+
+    def shard_for_hash_key(self, hash_key):
+        """
+        Return the id of the open shard owning hash_key, None if no open
+        shard covers it
+        """
+        i = bisect_right(self.starts, hash_key) - 1
+        if i >= 0 and hash_key <= self.ends[i]:
+            return self.shard_ids[i]
+        return None
+
+    def shards_for_hash_keys(self, hash_keys):
+        """
+        Return the shard ids for many hash keys, in the same order
+        """
+        starts = self.starts
+        ends = self.ends
+        shard_ids = self.shard_ids
+        result = []
+        for hash_key in hash_keys:
+            i = bisect_right(starts, hash_key) - 1
+            result.append(shard_ids[i] if i >= 0 and hash_key <= ends[i] else None)
+        return result
+
+    def shards_for_partition_keys(self, partition_keys):
+        return self.shards_for_hash_keys(hash_partition_keys(partition_keys))
+
+    def gaps(self):
+        """
+        Return the (start, end) hash key ranges not covered by an open shard
+        """
+        gaps = []
+        expected = 0
+        for start, end in zip(self.starts, self.ends):
+            if start > expected:
+                gaps.append((expected, start - 1))
+            expected = max(expected, end + 1)
+        if expected <= MAX_HASH_KEY:
+            gaps.append((expected, MAX_HASH_KEY))
+        return gaps
+
+    def overlaps(self):
+        """
+        Return (shard_id, shard_id) pairs of open shards sharing hash keys
+        """
+        overlaps = []
+        reach = -1
+        reach_shard_id = None
+        for start, end, shard_id in zip(self.starts, self.ends, self.shard_ids):
+            if start <= reach:
+                overlaps.append((reach_shard_id, shard_id))
+            if end > reach:
+                reach = end
+                reach_shard_id = shard_id
+        return overlaps
+
+
 @attr.s
 class KinesisClient(object):
     name = attr.ib()
@@ -45,14 +192,14 @@ class KinesisClient(object):
     aws_access_key_id = attr.ib(default=None)
     region = attr.ib(default='us-east-1')
     shard_details_dict = attr.ib(default=attr.Factory(dict))
+    shard_index = attr.ib(default=None)
 
     conn = attr.ib()
 
     @conn.default
     def init_conn(self):
-        return boto3.client('kinesis', region_name=self.region,
-                            aws_access_key_id=self.aws_access_key_id,
-                            aws_secret_access_key=self.aws_secret_access_key,)
+        return clients.client('kinesis', self.region, aws_access_key_id=self.aws_access_key_id,
+                              aws_secret_access_key=self.aws_secret_access_key)
 
     @handle_exceptions
     @validate_conn
@@ -76,17 +223,10 @@ class KinesisClient(object):
 
         print("Current Shard Count: {}\nTarget Shard Count: {}".format(current_shard_count, target_shard_count))
 
-        print("Waiting for stream status to be active")
-        retries = 0
-        status = self._get_stream_status()
-
-        while status != 'ACTIVE' and retries < MAX_RETRIES:
-            retries += 1
-            status = self._get_stream_status()
-            print('.', end='')
-            sleep(1)
+        if not self._wait_for_active():
+            print("{} did not become active in {}s".format(self.name, MAX_WAIT))
+            return False
 
-        print("Number of tries: {}".format(retries))
         print("Shard count after update: {}".format(self.get_shard_count(refresh=True)))
         return True
 
@@ -98,13 +238,19 @@ class KinesisClient(object):
 
     @validate_conn
     @handle_exceptions
-    def get_shard_details(self):
+    def get_shard_details(self, new_shards_only=False):
         """
         Create a dictionary of shard id details.
-        syntax: {shard_id: {starting_hash_key: key, ending_hash_key: key}}
+        syntax: {shard_id: {starting_hash_key: key, ending_hash_key: key, is_open: bool}}
+        Shard ids increase, so with new_shards_only only the shards
+        created since the last call are listed.
         """
 
-        response = self.conn.list_shards(StreamName=self.name,)
+        if new_shards_only and self.shard_details_dict:
+            response = self.conn.list_shards(StreamName=self.name,
+                                             ExclusiveStartShardId=max(self.shard_details_dict),)
+        else:
+            response = self.conn.list_shards(StreamName=self.name,)
         shard_list = response['Shards']
 
         while True:
@@ -112,7 +258,7 @@ class KinesisClient(object):
                 next_token = response['NextToken']
                 try:
                     response = self.conn.list_shards(NextToken=next_token)
-                    shard_list.append(response['Shards'])
+                    shard_list.extend(response['Shards'])
                 except self.conn.exceptions.ExpiredNextTokenException as e:
                     print("Invalid/Expired NextToken. Shard details incomplete")
                     print("{}".format(e))
@@ -126,28 +272,50 @@ class KinesisClient(object):
             print("Adding shard {}".format(shard_id))
             starting_hash_key = el['HashKeyRange']['StartingHashKey']
             ending_hash_key = el['HashKeyRange']['EndingHashKey']
+            # Closed shards (parents of a split/merge) have an ending sequence number
+            is_open = 'EndingSequenceNumber' not in el.get('SequenceNumberRange', {})
 
             self.shard_details_dict[shard_id] = {'starting_hash_key': starting_hash_key,
-                                                    'ending_hash_key': ending_hash_key}
+                                                    'ending_hash_key': ending_hash_key,
+                                                    'is_open': is_open}
 
+        self.shard_index = None
         return self.shard_details_dict
 
-    def get_shard_count(self, refresh=False):
+    def _shards_replaced(self, closed_shard_ids):
         """
-        Return the number of shards in the stream.
-        Update the shard_details_dict if refresh is True
+        Close the parents of a split/merge and add their children
         """
+        for shard_id in closed_shard_ids:
+            self.shard_details_dict[shard_id]['is_open'] = False
+        self.get_shard_details(new_shards_only=True)
 
+    def get_shard_index(self, refresh=False):
+        """
+        Return the ShardIndex of the open shards.
+        Update the shard_details_dict if refresh is True
+        """
         if refresh:
             self.get_shard_details()
 
-        return len(self.shard_details_dict)
+        if self.shard_index is None:
+            self.shard_index = ShardIndex.from_shard_details(self.shard_details_dict)
+        return self.shard_index
+
+    def get_shard_count(self, refresh=False):
+        """
+        Return the number of open shards in the stream.
+        Update the shard_details_dict if refresh is True
+        """
+
+        return len(self.get_shard_index(refresh=refresh))
 
     @handle_exceptions
     @validate_conn
-    def split_shard(self, shard_id):
+    def split_shard(self, shard_id, new_starting_hash_key=None):
         """
-        Split the shard and return True
+        Split the shard at new_starting_hash_key (the middle of its hash
+        key range by default) and return True
         """
 
         # Check if the stream is in ACTIVE state
@@ -163,24 +331,278 @@ class KinesisClient(object):
             print("Shard {} not found in shard details".format(shard_id))
             return False
 
-        starting_hash_key = str((int(hash_keys['starting_hash_key']) + int(hash_keys['ending_hash_key']))/2)
+        if new_starting_hash_key is None:
+            new_starting_hash_key = (int(hash_keys['starting_hash_key']) + int(hash_keys['ending_hash_key'])) // 2
+        starting_hash_key = str(new_starting_hash_key)
 
         self.conn.split_shard(StreamName=self.name,
                                 ShardToSplit=shard_id,
                                 NewStartingHashKey=starting_hash_key,)
 
-        print("Waiting for stream status to be active")
+        if not self._wait_for_active():
+            print("{} did not become active in {}s".format(self.name, MAX_WAIT))
+            return False
+
+        return True
+
+    @handle_exceptions
+    @validate_conn
+    def merge_shards(self, shard_id, adjacent_shard_id):
+        """
+        Merge two adjacent shards and return True
+        """
+
         status = self._get_stream_status()
-        retries = 0
 
-        while status != 'ACTIVE' and retries < MAX_RETRIES:
-            retries += 1
-            status = self._get_stream_status()
-            print('.', end='')
-            sleep(1)
+        if status != 'ACTIVE':
+            print("{} status is {}. Aborting shard merge".format(self.name, status))
+            return False
+
+        for el in (shard_id, adjacent_shard_id):
+            if not self.is_a_valid_shard(el):
+                print("Shard {} not found in shard details".format(el))
+                return False
+
+        self.conn.merge_shards(StreamName=self.name,
+                                ShardToMerge=shard_id,
+                                AdjacentShardToMerge=adjacent_shard_id,)
+
+        if not self._wait_for_active():
+            print("{} did not become active in {}s".format(self.name, MAX_WAIT))
+            return False
 
         return True
 
+    def plan_reshard(self, target):
+        """
+        Return the splits and merges turning the open shards into the
+        target layout.
+        syntax: [('merge', hash_key) | ('split', hash_key), ...]
+        A merge removes the shard boundary at hash_key and a split adds
+        it, so every operation changes the shard count by one.
+        target is either a list of starting hash keys, reached by
+        moving only the boundaries that differ (merges first, to keep
+        the shard count below max(current, target)), or a shard count,
+        reached in abs(target - current) operations by splitting the
+        widest shards or merging the narrowest neighbours.
+        """
+        if isinstance(target, int):
+            return self._plan_shard_count(target)
+
+        target = set(int(key) for key in target)
+        if 0 not in target:
+            print("The target layout must start at hash key 0")
+            return None
+
+        current = set(self.get_shard_index().starts)
+        merges = [('merge', key) for key in sorted(current - target)]
+        splits = [('split', key) for key in sorted(target - current)]
+        return merges + splits
+
+    def _plan_shard_count(self, target_count):
+        index = self.get_shard_index()
+        if target_count < 1 or not len(index):
+            print("Cannot reshard {} open shards to {}".format(len(index), target_count))
+            return None
+
+        plan = []
+        if target_count > len(index):
+            # Halve the widest shard each time
+            heap = [(start - end, start, end) for start, end in zip(index.starts, index.ends)]
+            heapq.heapify(heap)
+            for i in range(target_count - len(index)):
+                width, start, end = heapq.heappop(heap)
+                key = (start + end + 1) // 2
+                plan.append(('split', key))
+                heapq.heappush(heap, (start - key + 1, start, key - 1))
+                heapq.heappush(heap, (key - end, key, end))
+            return plan
+
+        # Merge the adjacent pair with the narrowest combined range each
+        # time. Heap entries go stale as shards merge and are skipped.
+        ends = dict(zip(index.starts, index.ends))
+        following = dict(zip(index.starts, index.starts[1:]))
+        preceding = dict((upper, lower) for lower, upper in following.items())
+        heap = []
+
+        def push(lower, upper):
+            if ends[lower] + 1 == upper:
+                heapq.heappush(heap, (ends[upper] - lower, upper, lower))
+
+        for lower, upper in following.items():
+            push(lower, upper)
+
+        while len(ends) > target_count and heap:
+            width, upper, lower = heapq.heappop(heap)
+            if following.get(lower) != upper or ends[upper] - lower != width:
+                continue
+
+            plan.append(('merge', upper))
+            ends[lower] = ends.pop(upper)
+            del preceding[upper]
+            after = following.pop(upper, None)
+            if after is None:
+                del following[lower]
+            else:
+                following[lower] = after
+                preceding[after] = lower
+                push(lower, after)
+            if lower in preceding:
+                push(preceding[lower], lower)
+
+        if len(ends) > target_count:
+            print("Only non adjacent shards left, stopping at {} shards".format(len(ends)))
+        return plan
+
+    def estimate_reshard(self, plan):
+        """
+        Return the estimated seconds needed to run a plan, operations on
+        a stream being serialised
+        """
+        return len(plan) * SECONDS_PER_OPERATION
+
+    def execute_reshard(self, plan):
+        """
+        Run a plan_reshard plan, resolving the shards involved in each
+        operation from the current index. Return the number of
+        operations done.
+        """
+        done = 0
+        for action, key in plan:
+            if not self.run_reshard_operation(action, key):
+                print("Failed to {} at {}".format(action, key))
+                break
+            done += 1
+
+        return done
+
+    def run_reshard_operation(self, action, key):
+        """
+        Run a single plan_reshard operation and update the shard details.
+        Return True on success.
+        """
+        index = self.get_shard_index()
+        if action == 'merge':
+            closed = [index.shard_for_hash_key(key - 1), index.shard_for_hash_key(key)]
+            if None in closed:
+                print("Could not find the shards around {}".format(key))
+                return False
+            ok = self.merge_shards(closed[0], closed[1])
+        else:
+            closed = [index.shard_for_hash_key(key)]
+            if None in closed:
+                print("Could not find the open shard holding {}".format(key))
+                return False
+            ok = self.split_shard(closed[0], new_starting_hash_key=key)
+
+        if ok:
+            self._shards_replaced(closed)
+        return bool(ok)
+
+    def shard_load(self, samples):
+        """
+        Assign (hash_key, weight) samples to the open shards.
+        syntax: {shard_id: [(hash_key, weight), ...]} sorted by hash_key
+        """
+        index = self.get_shard_index()
+
+        load = dict((shard_id, []) for shard_id in index.shard_ids)
+        shard_ids = index.shards_for_hash_keys([hash_key for hash_key, weight in samples])
+        for shard_id, sample in zip(shard_ids, samples):
+            if shard_id is not None:
+                load[shard_id].append(sample)
+
+        for shard_id in load:
+            load[shard_id].sort()
+        return load
+
+    def propose_splits(self, samples, target_load=None):
+        """
+        Propose split points that bring every open shard down to
+        target_load (the mean load per open shard by default), using as
+        few new shards as possible.
+        syntax: {shard_id: [new_starting_hash_key, ...]}
+        """
+        load = self.shard_load(samples)
+        total = sum(weight for hash_key, weight in samples)
+        if not load or not total:
+            return {}
+
+        if target_load is None:
+            target_load = float(total) / len(load)
+
+        plan = {}
+        for shard_id, shard_samples in load.items():
+            shard_total = sum(weight for hash_key, weight in shard_samples)
+            parts = int(math.ceil(shard_total / float(target_load)))
+            if parts < 2:
+                continue
+
+            # Split where the cumulative load crosses each 1/parts quantile
+            start = int(self.shard_details_dict[shard_id]['starting_hash_key'])
+            end = int(self.shard_details_dict[shard_id]['ending_hash_key'])
+            split_keys = []
+            cumulative = 0
+            quantile = 1
+            for hash_key, weight in shard_samples:
+                if cumulative >= quantile * shard_total / float(parts):
+                    key = hash_key
+                    if start < key <= end and (not split_keys or key > split_keys[-1]):
+                        split_keys.append(key)
+                    quantile += 1
+                    if quantile >= parts:
+                        break
+                cumulative += weight
+
+            if split_keys:
+                plan[shard_id] = split_keys
+
+        return plan
+
+    def execute_splits(self, plan):
+        """
+        Split each shard of a propose_splits plan at its hash keys, in
+        order, each split applying to the child that holds the key.
+        Return the number of splits done.
+        """
+        splits = 0
+        for shard_id, split_keys in plan.items():
+            current = shard_id
+            for key in split_keys:
+                if not self.split_shard(current, new_starting_hash_key=key):
+                    print("Failed to split {} at {}".format(current, key))
+                    break
+                splits += 1
+                self._shards_replaced([current])
+
+                # Later keys are above this one, so they belong to the upper child
+                current = self.get_shard_index().shard_for_hash_key(key)
+                if current is None:
+                    print("Could not find the open shard holding {}".format(key))
+                    break
+        return splits
+
+    def _wait_for_active(self, max_wait=MAX_WAIT):
+        """
+        Poll the stream status with exponential backoff until it is
+        ACTIVE. Return False if it is not after max_wait seconds.
+        """
+        print("Waiting for stream status to be active")
+        delay = WAIT_INITIAL_DELAY
+        waited = 0
+        with instrumentation.span('reshard_wait'):
+            status = self._get_stream_status()
+
+            while status != 'ACTIVE' and waited < max_wait:
+                sleep(delay)
+                waited += delay
+                delay = min(delay * 2, WAIT_MAX_DELAY)
+                status = self._get_stream_status()
+                print('.', end='')
+
+        print("Waited {}s".format(waited))
+        return status == 'ACTIVE'
+
     @handle_exceptions
     @validate_conn
     def _get_stream_status(self):
@@ -196,3 +618,59 @@ class KinesisClient(object):
             return response['StreamDescription']['StreamStatus']
         except self.conn.exceptions.ResourceInUseException:
             return 'IN_USE'
+
+
+if __name__ == "__main__":
+    import argparse
+    import atexit
+
+    parser = argparse.ArgumentParser(description='Split hot Kinesis shards at load-balanced hash keys')
+    parser.add_argument('--stream', '-s', dest='stream', required=True, help='Kinesis stream name')
+    parser.add_argument('--region', '-r', dest='region', default='us-east-1', help='AWS region')
+    parser.add_argument('--samples', dest='samples', default='-', help='File of sampled partition keys, one per line with an optional tab separated byte count. Defaults to stdin')
+    parser.add_argument('--target-load', dest='target_load', type=float, default=None, help='Maximum sampled load per shard. Defaults to the mean load per shard')
+    parser.add_argument('--execute', dest='execute', action='store_true', help='Execute the proposed splits or reshard plan')
+    parser.add_argument('--check', dest='check', action='store_true', help='Only check the hash key coverage of the open shards')
+    parser.add_argument('--target-count', dest='target_count', type=int, default=None, help='Reshard to this many shards with the fewest splits and merges instead of analysing samples')
+    parser.add_argument('--metrics', dest='metrics', default=None, help='Write the API call and stage timings to this file on exit, as JSON for .json files and as Prometheus text otherwise')
+    args = parser.parse_args()
+
+    if args.metrics:
+        atexit.register(instrumentation.DEFAULT_RECORDER.write, args.metrics)
+
+    client = KinesisClient(args.stream, region=args.region)
+    client.get_shard_details()
+
+    if args.check:
+        index = client.get_shard_index()
+        print("Open shards: {}\nClosed shards: {}".format(len(index), len(index.closed_shard_ids)))
+        for start, end in index.gaps():
+            print("Gap: {} - {}".format(start, end))
+        for first, second in index.overlaps():
+            print("Overlap: {} and {}".format(first, second))
+        sys.exit(0)
+
+    if args.target_count:
+        plan = client.plan_reshard(args.target_count)
+        if plan is None:
+            sys.exit(1)
+        for action, key in plan:
+            print("{} at {}".format(action, key))
+        print("{} operations, about {}s".format(len(plan), client.estimate_reshard(plan)))
+        if args.execute and plan:
+            print("Done {} operations".format(client.execute_reshard(plan)))
+        sys.exit(0)
+
+    if args.samples == '-':
+        samples = read_partition_key_samples(sys.stdin)
+    else:
+        with open(args.samples) as f:
+            samples = read_partition_key_samples(f)
+
+    plan = client.propose_splits(samples, target_load=args.target_load)
+    for shard_id, split_keys in sorted(plan.items()):
+        print("{}: split at {}".format(shard_id, ', '.join(str(key) for key in split_keys)))
+    print("{} new shards proposed".format(sum(len(keys) for keys in plan.values())))
+
+    if args.execute and plan:
+        print("Done {} splits".format(client.execute_splits(plan)))
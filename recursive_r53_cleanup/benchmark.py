@@ -0,0 +1,129 @@
+"""
+Time the fetch, populate and delete stages of the Route53 cleanup against
+synthetic zones and EC2 fleets, without any AWS account.
+"""
+from helper.r53_sqlite_database import R53SQLDatabase
+from helper.r53_aws_client import R53AWSClient
+from helper.ec2_aws_client import EC2AWSClient, REGIONS
+from helper.ec2_lookup_cache import EC2LookupCache
+from helper.fake_aws import CallStats, FakeRoute53, FakeEC2, generate_fleet, generate_zone
+from fetch_all_r53_records import fetch_records
+from populate_delete_record_set import populate_delete_records
+from delete_r53_records import delete_records
+# The helpers put aws_common on the path
+from aws_common import instrumentation, throttling
+import tracemalloc
+import tempfile
+import argparse
+import shutil
+import time
+import os
+
+HOSTED_ZONE_ID = 'ZBENCHMARK'
+
+def run_stage(name, func, stats, trace_memory):
+    stats.reset()
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+
+    peak = None
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {'stage': name, 'elapsed': elapsed, 'peak': peak, 'calls': dict(stats.calls),
+            'throttles': dict(stats.throttles), 'result': result}
+
+def print_report(results):
+    for result in results:
+        peak = "{0:.1f}MiB".format(result['peak'] / 1048576.0) if result['peak'] is not None else '-'
+        print("{0:<10} {1:>9.3f}s  peak {2:>9}  result {3}".format(result['stage'], result['elapsed'], peak, result['result']))
+        for operation in sorted(result['calls']):
+            print("    {0:<28} {1:>8} calls {2:>6} throttled".format(operation, result['calls'][operation], result['throttles'].get(operation, 0)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the Route53 cleanup pipeline against fake AWS clients')
+    parser.add_argument('--records', '-n', dest='records', type=int, default=10000, help='Number of resource record sets in the zone')
+    parser.add_argument('--instances', dest='instances', type=int, default=2000, help='Number of EC2 instances in the fleet')
+    parser.add_argument('--chain-depth', dest='chain_depth', type=int, default=2, help='Maximum CNAME chain length in front of each record')
+    parser.add_argument('--weighted-ratio', dest='weighted_ratio', type=float, default=0.1, help='Ratio of weighted record sets')
+    parser.add_argument('--alias-ratio', dest='alias_ratio', type=float, default=0.05, help='Ratio of alias record sets')
+    parser.add_argument('--orphan-ratio', dest='orphan_ratio', type=float, default=0.2, help='Ratio of records pointing to non-existent instances')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0, help='Seconds added to every fake API call')
+    parser.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=0.0, help='Probability of a fake API call failing with Throttling')
+    parser.add_argument('--aws-rate-limits', dest='aws_rate_limits', action='store_true', help='Hold the fake calls to the AWS request rates')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=1, help='Number of EC2 regions queried in parallel')
+    parser.add_argument('--inventory', '-i', dest='inventory', action='store_true', help='Use the bulk EC2 inventory')
+    parser.add_argument('--batch', '-b', dest='batch', action='store_true', help='Use batched EC2 lookups')
+    parser.add_argument('--cache', dest='cache', action='store_true', help='Use the EC2 lookup cache and run populate a second time against it')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true', help='Use an in-memory database')
+    parser.add_argument('--skip-delete', dest='skip_delete', action='store_true', help='Do not run the delete stage')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='Report peak Python memory per stage (slower)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Random seed for the synthetic data')
+    parser.add_argument('--metrics', dest='metrics', required=False, default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
+    args = parser.parse_args()
+
+    domain = 'example.com'
+    fleet = generate_fleet(args.instances, regions=REGIONS, seed=args.seed)
+    record_sets = generate_zone(fleet, records=args.records, domain=domain, chain_depth=args.chain_depth,
+                                weighted_ratio=args.weighted_ratio, alias_ratio=args.alias_ratio,
+                                orphan_ratio=args.orphan_ratio, seed=args.seed)
+    print("Zone: {0} record sets, Fleet: {1} instances".format(len(record_sets), args.instances))
+
+    stats = CallStats()
+    fake_options = {'stats': stats, 'latency': args.latency, 'throttle_rate': args.throttle_rate, 'seed': args.seed}
+
+    # Throttled fake calls are retried like real ones
+    throttler = throttling.Throttler(rate_limited=args.aws_rate_limits)
+
+    r53 = R53AWSClient(HOSTED_ZONE_ID)
+    r53.rc = throttling.install(FakeRoute53({HOSTED_ZONE_ID: (domain + '.', record_sets)}, **fake_options), 'route53', throttler=throttler)
+    r53.rc._index(HOSTED_ZONE_ID) # Keep the fake's own bookkeeping out of the measurements
+
+    ec2 = EC2AWSClient(max_workers=args.workers)
+    ec2.connection = dict((region, throttling.install(FakeEC2(fleet[region], **fake_options), 'ec2', region, throttler=throttler))
+                          for region in REGIONS)
+
+    # The database is created in the current directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    try:
+        r53_db = R53SQLDatabase(HOSTED_ZONE_ID, in_memory=args.in_memory)
+        results = []
+
+        results.append(run_stage('fetch', lambda: fetch_records(r53, r53_db), stats, args.trace_memory))
+
+        def populate():
+            if args.inventory:
+                ec2.build_inventory()
+            return populate_delete_records(r53_db, ec2, domain, batch=args.batch)
+        if args.cache:
+            ec2.cache = EC2LookupCache('ec2_lookup_cache.db')
+        results.append(run_stage('populate', populate, stats, args.trace_memory))
+        if args.cache:
+            print(ec2.cache.report())
+            results.append(run_stage('populate2', populate, stats, args.trace_memory))
+            print(ec2.cache.report())
+            ec2.cache.close()
+
+        if not args.skip_delete:
+            def delete():
+                deleted, failed, gone = delete_records(r53, r53_db)
+                return "{0} deleted, {1} failed, {2} already gone".format(len(deleted), len(failed), len(gone))
+            results.append(run_stage('delete', delete, stats, args.trace_memory))
+
+        r53_db.close_connection()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print_report(results)
+    print(throttler.report())
+    print(instrumentation.DEFAULT_RECORDER.summary())
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)
@@ -0,0 +1,134 @@
+from helper.r53_sqlite_database import R53SQLDatabase
+from helper.r53_aws_client import R53AWSClient
+from helper.ec2_aws_client import EC2AWSClient
+from fetch_all_r53_records import fetch_records
+from populate_delete_record_set import populate_delete_records
+from delete_r53_records import delete_records
+# The helpers put aws_common on the path
+from aws_common import clients, instrumentation
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+import traceback
+import argparse
+import sys
+import time
+
+DEBUG = False
+
+def new_summary(hosted_zone_id, domain, error=None):
+    return {'zone': hosted_zone_id, 'domain': domain, 'changed': 0, 'removed': 0,
+            'to_delete': 0, 'deleted': 0, 'gone': 0, 'failed': 0, 'elapsed': 0.0, 'error': error}
+
+def cleanup_zone(r53, domain, ec2, args, delete=False):
+    """
+    Run fetch -> populate -> (optional) delete for a single zone.
+    Return a summary dict.
+    """
+    start = time.time()
+    summary = new_summary(r53.hosted_zone_id, domain)
+
+    # sqlite connections can only be used by the thread that created them
+    r53_db = R53SQLDatabase(r53.hosted_zone_id, table_name=args.table_name, in_memory=args.in_memory)
+    try:
+        summary['changed'], summary['removed'] = fetch_records(r53, r53_db, incremental=args.incremental)
+        summary['to_delete'] = populate_delete_records(r53_db, ec2, domain, table_name=args.table_name,
+                                                       incremental=args.incremental)
+        if delete:
+            deleted, failed, gone = delete_records(r53, r53_db, args.table_name)
+            summary['deleted'] = len(deleted)
+            summary['gone'] = len(gone)
+            summary['failed'] = len(failed)
+    except Exception as e:
+        if DEBUG:
+            traceback.print_exc()
+        summary['error'] = "{0}".format(e)
+    finally:
+        r53_db.close_connection()
+
+    summary['elapsed'] = time.time() - start
+    return summary
+
+def print_report(summaries, elapsed):
+    columns = ['zone', 'domain', 'changed', 'removed', 'to_delete', 'deleted', 'gone', 'failed', 'elapsed', 'error']
+    print("\t".join(columns))
+    for summary in summaries:
+        row = dict(summary, elapsed="{0:.1f}".format(summary['elapsed']), error=summary['error'] or '')
+        print("\t".join("{0}".format(row[column]) for column in columns))
+
+    print('TOTAL')
+    print('=====')
+    print("Zones: {0}\nFailed zones: {1}".format(len(summaries), len([s for s in summaries if s['error']])))
+    for column in ['changed', 'removed', 'to_delete', 'deleted', 'gone', 'failed']:
+        print("{0}: {1}".format(column, sum(s[column] for s in summaries)))
+    print("Elapsed: {0:.1f}s".format(elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find (and delete) orphan Route53 records in many hosted zones')
+    parser.add_argument('--access-key-id', '-a', dest='access_key_id', required=False, default=None, help='AWS Access Key Id')
+    parser.add_argument('--secret-access-key', '-k', dest='secret_access_key', required=False, default=None, help='AWS Secret Access Key')
+    parser.add_argument('--table', '-t', dest='table_name', required=False, default='records', help='Table name in the database')
+    parser.add_argument('--hosted-zone-id', '-z', dest='hosted_zone_ids', action='append', default=[], help='Route53 hosted zone ID, can be repeated. Defaults to all hosted zones')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=4, help='Number of zones processed in parallel')
+    parser.add_argument('--route53-concurrency', dest='r53_concurrency', type=int, default=4, help='Maximum number of concurrent Route53 calls')
+    parser.add_argument('--ec2-concurrency', dest='ec2_concurrency', type=int, default=6, help='Maximum number of concurrent EC2 calls')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Update the records from the previous run instead of recreating the tables')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true', help='Work on in-memory copies of the databases and save them at the end')
+    parser.add_argument('--delete', dest='delete', action='store_true', help='Delete the orphan records')
+    parser.add_argument('--metrics', dest='metrics', required=False, default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
+    args = parser.parse_args()
+
+    start = time.time()
+    r53_semaphore = BoundedSemaphore(args.r53_concurrency)
+    ec2_semaphore = BoundedSemaphore(args.ec2_concurrency)
+
+    # Size the connection pools of the shared clients to the concurrent calls
+    clients.set_concurrency(max(args.r53_concurrency, args.ec2_concurrency))
+
+    # Create all connection objects
+    r53 = R53AWSClient(None, aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key, semaphore=r53_semaphore)
+    if args.hosted_zone_ids:
+        zones = []
+        for hosted_zone_id in args.hosted_zone_ids:
+            r53.hosted_zone_id = hosted_zone_id
+            zones.append((hosted_zone_id, r53.get_hosted_zone_name()))
+    else:
+        zones = r53.list_hosted_zones()
+
+    # One EC2 inventory shared by all zones
+    ec2 = EC2AWSClient(aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key,
+                       max_workers=args.ec2_concurrency, semaphore=ec2_semaphore)
+    ec2.build_inventory()
+
+    # Records of the regions missing from the inventory are looked up
+    # through the API, but nothing is deleted on a partial view of EC2
+    delete = args.delete
+    if delete and not ec2.inventory_complete():
+        print("EC2 inventory incomplete ({0}), not deleting".format(', '.join(ec2.inventory_failed_regions)))
+        delete = False
+
+    summaries = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = []
+        for hosted_zone_id, domain in zones:
+            if not domain:
+                summaries.append(new_summary(hosted_zone_id, domain, error='Failed to get the hosted zone name'))
+                continue
+            zone_r53 = R53AWSClient(hosted_zone_id, aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key, semaphore=r53_semaphore)
+            futures.append(executor.submit(cleanup_zone, zone_r53, domain.strip('.'), ec2, args, delete))
+
+        for future in futures:
+            summaries.append(future.result())
+
+    if args.delete and not delete:
+        for summary in summaries:
+            if not summary['error']:
+                summary['error'] = 'Not deleted, EC2 inventory incomplete'
+
+    print_report(summaries, time.time() - start)
+
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)
+
+    # e.g. an incomplete fetch, the zone was left as it was
+    if any(summary['error'] for summary in summaries):
+        sys.exit(1)
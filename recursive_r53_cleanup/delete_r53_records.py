@@ -1,39 +1,92 @@
 from helper.r53_sqlite_database import R53SQLDatabase
 from helper.r53_aws_client import R53AWSClient
+from botocore.exceptions import ClientError
+# The helpers put aws_common on the path
+from aws_common import instrumentation
 import argparse
+import json
+import sys
 
 DEBUG = True
 
+def record_set_not_found(change, error):
+    """
+    True when Route53 rejected the change because its record set, matched
+    on name, type and set identifier, does not exist. A record set whose
+    values or TTL changed still exists and is not gone.
+    """
+    record_set = change['ResourceRecordSet']
+    description = "name='{0}', type='{1}'".format(record_set['Name'], record_set['Type'])
+    if record_set.get('SetIdentifier'):
+        description += ", set-identifier='{0}'".format(record_set['SetIdentifier'])
+    return "Tried to delete resource record set [{0}] but it was not found".format(description) in error
+
+def delete_records(r53, r53_db, table_name='records', dry_run=False):
+    """
+    Delete every record in <table_name>_to_del not deleted by a previous
+    run from Route53, journaling each change batch in the database.
+    With dry_run, return the change batches instead of submitting them.
+    Return (deleted, failed, gone) as lists of (name, rtype, value, ttl),
+    gone being the records Route53 no longer had, e.g. deleted by an
+    interrupted run.
+    """
+    # Get the records that still need to be deleted
+    records = []
+    for name, value, rtype, ttl, set_id, weight in r53_db.get_pending_deletes():
+        set_id = set_id if set_id != 'null' else None
+        records.append((name, rtype, value, ttl, set_id, weight))
+
+    if dry_run:
+        return r53.plan_change_batches(records)
+
+    gone = []
+
+    def journal(index, deleted, failed):
+        # Records deleted by an interrupted run are already gone
+        batch_gone = [change for change, error in failed if record_set_not_found(change, error)]
+        failed = [(change, error) for change, error in failed if not record_set_not_found(change, error)]
+        r53_db.journal_delete_batch(deleted + batch_gone, failed)
+        for change in batch_gone:
+            gone.extend(r53._change_values(change))
+
+    with instrumentation.span('delete'):
+        deleted, failed = r53.delete_record_sets(records, on_batch=journal)
+    already_gone = set(gone)
+    failed = [record for record in failed if record not in already_gone]
+    return deleted, failed, gone
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate a simple database of Route53 records')
     parser.add_argument('--access-key-id', '-a', dest='access_key_id', required=False, default=None, help='AWS Access Key Id')
     parser.add_argument('--secret-access-key', '-k', dest='secret_access_key', required=False, default=None, help='AWS Secret Access Key')
     parser.add_argument('--table', '-t', dest='table_name', required=False, default='records', help='Table name in the database')
     parser.add_argument('--hosted-zone-id', '-z', dest='hosted_zone_id', required=True, help='Route53 hosted zone ID')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Print the change batches without calling Route53')
+    parser.add_argument('--metrics', dest='metrics', required=False, default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
     args = parser.parse_args()
 
     if DEBUG:
         print("Access key: {0}\nSecret key: {1}\nHosted zone id: {2}\nTable Name: {3}".format(args.access_key_id, args.secret_access_key, args.hosted_zone_id, args.table_name))
 
-    table_name = args.table_name
-    table_name_to_del = "{0}_to_del".format(table_name)
-
     # Create all connection objects
     r53 = R53AWSClient(args.hosted_zone_id, aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key)
-    r53_db = R53SQLDatabase(args.hosted_zone_id)# Get the records that needs to be deleted
+    r53_db = R53SQLDatabase(args.hosted_zone_id, table_name=args.table_name)
 
-    # Get the records that needs to be deleted
-    query = "SELECT name, value, type, ttl, set_id, weight from {table_name};".format(table_name=table_name_to_del)
-    all_records_to_delete = r53_db.execute_query(query)
-    deleted_records = []
-    failed_to_del = []
+    if args.dry_run:
+        for batch in delete_records(r53, r53_db, args.table_name, dry_run=True):
+            print(json.dumps({'HostedZoneId': args.hosted_zone_id,
+                              'ChangeBatch': {'Comment': 'Deleted part of clean up', 'Changes': batch}}))
+        r53_db.close_connection()
+        sys.exit(0)
 
-    for name, value, rtype, ttl, set_id, weight in all_records_to_delete:
-        set_id = set_id if set_id != 'null' else None
-        if r53.delete_record_set(name, rtype, value, ttl, set_id, weight):
-            deleted_records.append((name, rtype, value, ttl))
-        else:
-            failed_to_del.append((name, rtype, value, ttl))
+    try:
+        deleted_records, failed_to_del, already_gone = delete_records(r53, r53_db, args.table_name)
+    except ClientError as e:
+        # The batches done so far are journaled, a new run resumes after them
+        print('Deletion stopped, run again to resume')
+        print("{error}".format(error=e))
+        r53_db.close_connection()
+        sys.exit(1)
 
     if DEBUG:
         print('DELETED RECORDS')
@@ -41,9 +94,17 @@ if __name__ == "__main__":
         for name, rtype, value, ttl in deleted_records:
             print("{0} {1} {2}".format(name, rtype, value))
 
+        print('ALREADY GONE')
+        print('============')
+        for name, rtype, value, ttl in already_gone:
+            print("{0} {1} {2}".format(name, rtype, value))
+
         print("FAILED TO DELETE")
         print('=================')
         for name, rtype, value, ttl in failed_to_del:
             print("{0} {1} {2}".format(name, rtype, value))
 
     r53_db.close_connection()
+
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)
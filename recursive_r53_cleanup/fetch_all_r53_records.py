@@ -1,32 +1,61 @@
 from helper.r53_sqlite_database import R53SQLDatabase
-from helper.r53_aws_client import R53AWSClient
+from helper.r53_aws_client import R53AWSClient, RecordFetchError
+# The helpers put aws_common on the path
+from aws_common import instrumentation
 import argparse
+import sys
 
 DEBUG = False
 
+def fetch_records(r53, r53_db, incremental=False):
+    """
+    Load every record of the zone into the database.
+    Return (changed, removed) record counts. Raise RecordFetchError if
+    the listing did not reach the last page, the records missing from it
+    are not removed then.
+    """
+    r53_db.initialize_database(incremental=incremental) # Create records table
+
+    # Fetch all resource records for the zone and populate the database
+    # page by page while the next pages are still being fetched
+    with instrumentation.span('fetch'):
+        r53_db.upload_resource_record_pages(r53.prefetch_resource_record_pages())
+
+    if not r53.fetch_complete:
+        raise RecordFetchError("Fetch of {zone} is incomplete, not removing the missing records".format(zone=r53.hosted_zone_id))
+
+    # Remove records that are no longer in the zone
+    with instrumentation.span('sync'):
+        return r53_db.finish_sync()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate a simple database of Route53 records')
     parser.add_argument('--access-key-id', '-a', dest='access_key_id', required=False, default=None, help='AWS Access Key Id')
     parser.add_argument('--secret-access-key', '-k', dest='secret_access_key', required=False, default=None, help='AWS Secret Access Key')
     parser.add_argument('--table', '-t', dest='table_name', required=False, default='records', help='Table name in the database')
     parser.add_argument('--hosted-zone-id', '-z', dest='hosted_zone_id', required=True, help='Route53 hosted zone ID')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Update the records from the previous run instead of recreating the table')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true', help='Work on an in-memory copy of the database and save it at the end')
+    parser.add_argument('--metrics', dest='metrics', required=False, default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
     args = parser.parse_args()
 
     if DEBUG:
         print("Access key: {0}\nSecret key: {1}\nHosted zone id: {2}\nTable Name: {3}".format(args.access_key_id, args.secret_access_key, args.hosted_zone_id, args.table_name))
 
-    table_name = args.table_name
-    table_name_to_del = "{0}_to_del".format(table_name)
-
     # Create all connection objects
     r53 = R53AWSClient(args.hosted_zone_id, aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key)
-    r53_db = R53SQLDatabase(args.hosted_zone_id)
-
-    # Fetch all resource records for the zone
-    r53.get_all_resource_records()
-
-    r53_db.initialize_database() # Create records table
+    r53_db = R53SQLDatabase(args.hosted_zone_id, table_name=args.table_name, in_memory=args.in_memory)
+
+    try:
+        changed, removed = fetch_records(r53, r53_db, incremental=args.incremental)
+    except RecordFetchError as e:
+        print("{error}".format(error=e))
+        r53_db.close_connection()
+        sys.exit(1)
+    if DEBUG:
+        print("Changed records: {0}\nRemoved records: {1}".format(changed, removed))
 
-    # Populate resource records database
-    r53_db.upload_resource_records(r53.resource_records)
     r53_db.close_connection()
+
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)
@@ -1,58 +1,276 @@
 from botocore.exceptions import ClientError
-import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 import ipaddress
+import os
+import sys
+
+# aws_common is shared by all the tools and lives at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from aws_common import clients, instrumentation
 
 REGIONS = ['us-east-1', 'us-west-1', 'eu-west-1', 'eu-central-1', 'ap-southeast-1', 'ap-northeast-1']
+BATCH_SIZE = 200 # Maximum number of values in a single describe_instances filter
+
+# Instance attribute matching each describe_instances filter
+FILTER_ATTRIBUTES = {'dns-name': 'PublicDnsName',
+                     'ip-address': 'PublicIpAddress',
+                     'private-ip-address': 'PrivateIpAddress',
+                     'private-dns-name': 'PrivateDnsName'}
 
 class EC2AWSClient(object):
 
-    def __init__(self, aws_secret_access_key=None, aws_access_key_id=None):
-        self.connection = {}
-        for region in REGIONS:
+    def __init__(self, aws_secret_access_key=None, aws_access_key_id=None, max_workers=1, semaphore=None, cache=None):
+        # Clients are created on the first call to their region
+        clients.set_concurrency(max_workers)
+        self.connection = clients.regional('ec2', REGIONS, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+
+        self.inventory = None
+        # Regions build_inventory could not fetch, searched through the API
+        self.inventory_failed_regions = []
+        self.cache = cache
+        self.max_workers = max_workers
+        self.semaphore = semaphore if semaphore else nullcontext()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+
+    def _empty_inventory(self):
+        return {'dns-name': {}, 'ip-address': {}, 'private-ip-address': {}, 'private-dns-name': {}}
+
+    def _instance_name(self, instance):
+        for tag in instance.get('Tags', []):
+            if tag['Key'] == 'Name':
+                return tag['Value']
+        return None
+
+    def build_inventory(self):
+        """
+        Fetch every instance in every region once and index it by
+        private/public ip and private/public dns name. Regions that fail
+        are left out of the index and listed in inventory_failed_regions,
+        lookups fall back to the API for them.
+        syntax: {filter_key: {value: {region: (region, instance_id, instance_name)}}}
+        """
+        inventory = self._empty_inventory()
+        failed_regions = []
+
+        # Regions are swept in parallel when an executor is available
+        with instrumentation.span('ec2_inventory'):
+            for region, instances in self._map(self._region_instances):
+                if instances is None:
+                    failed_regions.append(region)
+                    continue
+                for instance in instances:
+                    self.add_to_inventory(region, instance['InstanceId'], self._instance_name(instance),
+                                          private_ip=instance.get('PrivateIpAddress'),
+                                          public_ip=instance.get('PublicIpAddress'),
+                                          private_dns=instance.get('PrivateDnsName'),
+                                          public_dns=instance.get('PublicDnsName'),
+                                          inventory=inventory)
+
+        self.inventory = inventory
+        self.inventory_failed_regions = sorted(failed_regions)
+        return self.inventory
+
+    def inventory_complete(self):
+        return self.inventory is not None and not self.inventory_failed_regions
+
+    def _region_instances(self, region):
+        """
+        Return (region, instances), instances being None when the region
+        could not be fetched
+        """
+        instances = []
+        try:
+            paginator = self.connection[region].get_paginator('describe_instances')
+            with self.semaphore:
+                for page in paginator.paginate():
+                    for reservation in page['Reservations']:
+                        instances.extend(reservation['Instances'])
+        except ClientError as e:
+            print("Error fetching instances in {region}".format(region=region))
+            print("{error}".format(error=e))
+            instances = None
+
+        return region, instances
+
+    def add_to_inventory(self, region, instance_id, instance_name, private_ip=None, public_ip=None, private_dns=None, public_dns=None, inventory=None):
+        if inventory is None:
+            if self.inventory is None:
+                self.inventory = self._empty_inventory()
+            inventory = self.inventory
+
+        output = (region, instance_id, instance_name)
+        for filter_key, value in (('private-ip-address', private_ip),
+                                  ('ip-address', public_ip),
+                                  ('private-dns-name', private_dns),
+                                  ('dns-name', public_dns)):
+            if value:
+                # Private addresses and names repeat across regions
+                inventory[filter_key].setdefault(value.strip('.'), {})[region] = output
+
+    def _describe_instances(self, region, filter_key, values):
+        """
+        Return (region, reservations) matching any of the values
+        """
+        reservations = []
+        paginator = self.connection[region].get_paginator('describe_instances')
+        with self.semaphore:
+            for page in paginator.paginate(Filters=[{'Name': filter_key, 'Values': values}]):
+                reservations.extend(page['Reservations'])
+        return region, reservations
+
+    def _regions(self, region=None):
+        """
+        Regions to search: only the given one when we have a connection
+        for it, every region otherwise
+        """
+        if region in self.connection:
+            return [region]
+        return list(self.connection)
+
+    def _map(self, func, *args, regions=None):
+        """
+        Call func(region, *args) for every region, in parallel when an
+        executor is available. Yields results in completion order.
+        """
+        regions = regions if regions else list(self.connection)
+        if self.executor and len(regions) > 1:
+            futures = [self.executor.submit(func, region, *args) for region in regions]
             try:
-                self.connection[region] = boto3.client('ec2', region_name=region, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
-            except ClientError as e:
-                print("Error getting a connection for {region}".format(region=region))
-                print("{error}".format(error=e))
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Skip any regions not queried yet once the caller stops early
+                for future in futures:
+                    future.cancel()
+        else:
+            for region in regions:
+                yield func(region, *args)
+
+    def inventory_rows(self):
+        """
+        Return the inventory as (filter_key, value, region, instance_id, instance_name) tuples
+        """
+        rows = []
+        if self.inventory:
+            for filter_key in self.inventory:
+                for value, outputs in self.inventory[filter_key].items():
+                    for region, instance_id, instance_name in outputs.values():
+                        rows.append((filter_key, value, region, instance_id, instance_name))
+        return rows
 
-    def search_instance(self, filter_type, value, verbose):
+    def load_inventory(self, rows):
+        self.inventory_failed_regions = []
+        self.inventory = self._empty_inventory()
+        for filter_key, value, region, instance_id, instance_name in rows:
+            self.inventory[filter_key].setdefault(value, {})[region] = (region, instance_id, instance_name)
+
+    def _filter_key(self, filter_type, value):
         if filter_type == 'cname':
-            filter_key = 'dns-name'
+            return 'dns-name'
 
         if filter_type == 'ip':
-            filter_key = 'private-ip-address' if ipaddress.ip_address(value).is_private else 'ip-address'
+            return 'private-ip-address' if ipaddress.ip_address(value.strip('.')).is_private else 'ip-address'
 
         if filter_type == 'private_dns':
-            filter_key = 'private-dns-name'
-
-        reservation = None
-        found = False
-        for region in self.connection:
-            response = self.connection[region].describe_instances(
-                        Filters=[{
-                            'Name': filter_key,
-                            'Values': [value.strip('.')]
-                            }]
-                        )
-
-            if len(response['Reservations']) > 0:
-                found = True
-                reservation = response['Reservations'][0] # Assuming that the reservation will be unique
+            return 'private-dns-name'
+
+    def search_instance(self, filter_type, value, verbose, region=None):
+        """
+        region: search only this region, e.g. the one encoded in an EC2 hostname
+        """
+        filter_key = self._filter_key(filter_type, value)
+        regions = self._regions(region)
+
+        # Answer from the inventory index when one has been built
+        if self.inventory is not None:
+            instrumentation.add('ec2_lookup_inventory')
+            outputs = self.inventory[filter_key].get(value.strip('.'), {})
+            # Only an instance of the regions searched counts
+            output = next((outputs[name] for name in regions if name in outputs), None)
+            # Not found, but regions missing from the inventory may have it
+            regions = [name for name in regions if name in self.inventory_failed_regions]
+            if output is not None or not regions:
+                if verbose and output:
+                    return output
+                return output is not None
+
+        # Then from the lookup cache
+        if self.cache:
+            output = self.cache.get(filter_key, value.strip('.'), regions)
+            if output is not None:
+                instrumentation.add('ec2_lookup_cache_hit')
+                return output if verbose and output else bool(output)
+
+        output = False
+        for region, reservations in self._map(self._describe_instances, filter_key, [value.strip('.')], regions=regions):
+            if len(reservations) > 0:
+                reservation = reservations[0] # Assuming that the reservation will be unique
+                instance_id = reservation['Instances'][0]['InstanceId']
+                instance_name = self._instance_name(reservation['Instances'][0])
+                output = (region, instance_id, instance_name)
                 break
 
-        if verbose and found:
-            instance_id = reservation['Instances'][0]['InstanceId']
-            instance_name = None
+        instrumentation.add('ec2_lookup_api_found' if output else 'ec2_lookup_api_missing')
+        if self.cache:
+            self.cache.put(filter_key, value.strip('.'), regions, output)
 
-            for tag in reservation['Instances'][0]['Tags']:
-                if tag['Key'] == 'Name':
-                    instance_name = tag['Value']
-                    break
+        return output if verbose and output else bool(output)
 
-            output = (region, instance_id, instance_name)
-            return output
-        else:
-            return found
+    def search_instances(self, filter_type, values, verbose=False, region=None):
+        """
+        Search many values at once, packing up to BATCH_SIZE values into a
+        single filter per region. region restricts the search as in
+        search_instance.
+        syntax: {value: (region, instance_id, instance_name) or False}
+        """
+        if self.inventory is not None:
+            return dict((value, self.search_instance(filter_type, value, verbose, region=region)) for value in values)
+
+        regions = self._regions(region)
+        output = {}
+        grouped = {}
+        for value in values:
+            output[value] = False
+            grouped.setdefault(self._filter_key(filter_type, value), []).append(value)
+
+        for filter_key, group in grouped.items():
+            attribute = FILTER_ATTRIBUTES[filter_key]
+            stripped = {}
+            for value in group:
+                stripped.setdefault(value.strip('.'), []).append(value)
+
+            # Values with a fresh cache entry are not looked up
+            if self.cache:
+                for key in list(stripped):
+                    cached = self.cache.get(filter_key, key, regions)
+                    if cached is not None:
+                        instrumentation.add('ec2_lookup_cache_hit')
+                        for value in stripped.pop(key):
+                            output[value] = cached
+            keys = list(stripped)
+
+            results = dict((key, False) for key in keys)
+            for i in range(0, len(keys), BATCH_SIZE):
+                for found_region, reservations in self._map(self._describe_instances, filter_key, keys[i:i + BATCH_SIZE], regions=regions):
+                    for reservation in reservations:
+                        for instance in reservation['Instances']:
+                            matched = (instance.get(attribute) or '').strip('.')
+                            if matched in results:
+                                results[matched] = (found_region, instance['InstanceId'], self._instance_name(instance))
+
+            for key, result in results.items():
+                instrumentation.add('ec2_lookup_api_found' if result else 'ec2_lookup_api_missing')
+                for value in stripped[key]:
+                    output[value] = result
+
+            if self.cache:
+                self.cache.put_many((filter_key, key, regions, result) for key, result in results.items())
+
+        if not verbose:
+            output = dict((value, bool(result)) for value, result in output.items())
+
+        return output
 
     def search_instance_by_cname(self, cname, verbose=False):
         self.search_instance('cname', cname, verbose)
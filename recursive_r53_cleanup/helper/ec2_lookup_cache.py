@@ -0,0 +1,111 @@
+from threading import Lock
+import sqlite3
+import time
+
+DEBUG = False
+
+class EC2LookupCache(object):
+    """
+    Persistent cache of EC2 lookups keyed by (filter_key, value) and the
+    regions searched. A found instance answers any later lookup covering
+    its region, a miss only lookups of the same or fewer regions. Found
+    and not found results expire after positive_ttl and negative_ttl
+    seconds. The cache file can be shared by all zones.
+    """
+
+    def __init__(self, db_name='ec2_lookup_cache.db', positive_ttl=86400, negative_ttl=3600, max_entries=1000000):
+        self.db_name = db_name
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # Lookups can come from several zone workers at once
+        self.lock = Lock()
+        self.connection = sqlite3.connect(self.db_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL;")
+        self.connection.execute("PRAGMA synchronous=NORMAL;")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(ec2_lookup_cache);")]
+        if columns and 'regions' not in columns:
+            # Entries of a cache file predating the regions can't be trusted
+            self.connection.execute("DROP TABLE ec2_lookup_cache;")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ec2_lookup_cache(filter_key VARCHAR, value VARCHAR, regions VARCHAR, found BOOLEAN, region VARCHAR, instance_id VARCHAR, instance_name VARCHAR, checked_at INTEGER, PRIMARY KEY (filter_key, value, regions))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ec2_lookup_cache_checked_at_idx ON ec2_lookup_cache(checked_at);")
+        self.connection.commit()
+
+    def _is_fresh(self, found, checked_at, now):
+        ttl = self.positive_ttl if found else self.negative_ttl
+        return checked_at >= now - ttl
+
+    def get(self, filter_key, value, regions):
+        """
+        Return (region, instance_id, instance_name) or False for the
+        latest fresh entry answering a lookup of regions, None when the
+        value has to be looked up
+        """
+        query = "SELECT found, region, instance_id, instance_name, checked_at, regions FROM ec2_lookup_cache WHERE filter_key=? AND value=? ORDER BY checked_at DESC;"
+        now = time.time()
+        with self.lock:
+            for found, region, instance_id, instance_name, checked_at, searched in self.connection.execute(query, (filter_key, value)).fetchall():
+                if not self._is_fresh(found, checked_at, now):
+                    continue
+                if found and region in regions:
+                    self.hits += 1
+                    return region, instance_id, instance_name
+                if not found and set(regions) <= set(searched.split(',')):
+                    self.hits += 1
+                    return False
+
+            self.misses += 1
+            return None
+
+    def put(self, filter_key, value, regions, output):
+        """
+        regions: the regions searched
+        output: (region, instance_id, instance_name) or False
+        """
+        self.put_many([(filter_key, value, regions, output)])
+
+    def put_many(self, entries):
+        query = "INSERT OR REPLACE INTO ec2_lookup_cache (filter_key, value, regions, found, region, instance_id, instance_name, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?);"
+        now = int(time.time())
+        rows = []
+        for filter_key, value, regions, output in entries:
+            searched = ','.join(sorted(regions))
+            if output:
+                region, instance_id, instance_name = output
+                rows.append((filter_key, value, searched, 1, region, instance_id, instance_name, now))
+            else:
+                rows.append((filter_key, value, searched, 0, None, None, None, now))
+
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(query, rows)
+
+    def evict(self):
+        """
+        Drop expired entries, then the oldest ones above max_entries.
+        Return the number of entries removed.
+        """
+        now = int(time.time())
+        with self.lock:
+            with self.connection:
+                removed = self.connection.execute("DELETE FROM ec2_lookup_cache WHERE (found=1 AND checked_at<?) OR (found=0 AND checked_at<?);",
+                                                  (now - self.positive_ttl, now - self.negative_ttl)).rowcount
+
+                count, = self.connection.execute("SELECT COUNT(*) FROM ec2_lookup_cache;").fetchone()
+                if count > self.max_entries:
+                    removed += self.connection.execute("DELETE FROM ec2_lookup_cache WHERE rowid IN (SELECT rowid FROM ec2_lookup_cache ORDER BY checked_at LIMIT ?);",
+                                                       (count - self.max_entries,)).rowcount
+        if DEBUG:
+            print("Evicted {0} cache entries".format(removed))
+        return removed
+
+    def report(self):
+        return "EC2 lookup cache: {0} hits, {1} misses".format(self.hits, self.misses)
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+        self.connection = None
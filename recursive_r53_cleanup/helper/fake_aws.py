@@ -0,0 +1,300 @@
+"""
+Offline stand-ins for the boto3 Route53 and EC2 clients used by the cleanup
+scripts, plus generators for synthetic zones and EC2 fleets. Only the calls
+and response fields the scripts use are implemented.
+"""
+from botocore.exceptions import ClientError
+from threading import Lock
+import ipaddress
+import random
+import time
+
+# describe_instances filter name -> instance attribute
+FILTER_ATTRIBUTES = {'dns-name': 'PublicDnsName',
+                     'ip-address': 'PublicIpAddress',
+                     'private-ip-address': 'PrivateIpAddress',
+                     'private-dns-name': 'PrivateDnsName'}
+
+
+class CallStats(object):
+    """
+    Thread safe call counter shared by all the fake clients
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.throttles = {}
+
+    def add(self, operation, throttled=False):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if throttled:
+                self.throttles[operation] = self.throttles.get(operation, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.throttles = {}
+
+
+class FakeClient(object):
+    """
+    Base for the fake clients. Every call sleeps for latency seconds and
+    fails with a Throttling error with probability throttle_rate.
+    """
+
+    def __init__(self, stats=None, latency=0.0, throttle_rate=0.0, seed=None):
+        self.stats = stats if stats else CallStats()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+    def _call(self, operation):
+        if self.latency:
+            time.sleep(self.latency)
+
+        throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+        self.stats.add(operation, throttled)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, operation)
+
+
+class FakePaginator(object):
+
+    def __init__(self, method, token_key, result_key):
+        self.method = method
+        self.token_key = token_key
+        self.result_key = result_key
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get(self.result_key):
+                break
+            kwargs[self.token_key] = page[self.result_key]
+
+
+class FakeRoute53(FakeClient):
+
+    def __init__(self, zones, **kwargs):
+        """
+        zones: {hosted_zone_id: (name, [resource record sets])}
+        """
+        FakeClient.__init__(self, **kwargs)
+        self.zones = zones
+        self.lock = Lock()
+        self.indexes = {}
+
+    def _index(self, hosted_zone_id):
+        """
+        {(name, type, set_id): position} for a zone, rebuilt after changes
+        """
+        if hosted_zone_id not in self.indexes:
+            index = {}
+            for i, record_set in enumerate(self.zones[hosted_zone_id][1]):
+                index.setdefault((record_set['Name'], record_set['Type'], record_set.get('SetIdentifier')), i)
+                # First set of a name and type, used when no identifier is given
+                index.setdefault((record_set['Name'], record_set['Type'], None), i)
+            self.indexes[hosted_zone_id] = index
+        return self.indexes[hosted_zone_id]
+
+    def get_paginator(self, operation):
+        if operation == 'list_hosted_zones':
+            return FakePaginator(self.list_hosted_zones, 'Marker', 'NextMarker')
+        raise NotImplementedError(operation)
+
+    def list_hosted_zones(self, Marker=None, MaxItems='100'):
+        self._call('ListHostedZones')
+        zone_ids = sorted(self.zones)
+        start = zone_ids.index(Marker) if Marker else 0
+        page = zone_ids[start:start + int(MaxItems)]
+
+        response = {'HostedZones': [{'Id': "/hostedzone/{0}".format(zone_id), 'Name': self.zones[zone_id][0]} for zone_id in page]}
+        if start + int(MaxItems) < len(zone_ids):
+            response['NextMarker'] = zone_ids[start + int(MaxItems)]
+        return response
+
+    def get_hosted_zone(self, Id):
+        self._call('GetHostedZone')
+        return {'HostedZone': {'Id': "/hostedzone/{0}".format(Id), 'Name': self.zones[Id][0]}}
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None, StartRecordIdentifier=None, MaxItems='100'):
+        self._call('ListResourceRecordSets')
+        with self.lock:
+            record_sets = self.zones[HostedZoneId][1]
+            index = self._index(HostedZoneId)
+
+            start = 0
+            if StartRecordName:
+                start = index.get((StartRecordName, StartRecordType, StartRecordIdentifier), 0)
+
+            end = start + int(MaxItems)
+            response = {'ResourceRecordSets': record_sets[start:end], 'IsTruncated': end < len(record_sets)}
+            if response['IsTruncated']:
+                response['NextRecordName'] = record_sets[end]['Name']
+                response['NextRecordType'] = record_sets[end]['Type']
+                if 'SetIdentifier' in record_sets[end]:
+                    response['NextRecordIdentifier'] = record_sets[end]['SetIdentifier']
+        return response
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        """
+        Only DELETE is supported. Like Route53, the whole batch is rejected
+        if any record set does not exactly match an existing one, with
+        distinct errors for a missing record set and for one whose values
+        or TTL differ.
+        """
+        self._call('ChangeResourceRecordSets')
+        with self.lock:
+            record_sets = self.zones[HostedZoneId][1]
+            index = self._index(HostedZoneId)
+            matches = []
+            for change in ChangeBatch['Changes']:
+                wanted = change['ResourceRecordSet']
+                if change['Action'] != 'DELETE':
+                    raise NotImplementedError(change['Action'])
+
+                match = index.get((wanted['Name'], wanted['Type'], wanted.get('SetIdentifier')))
+                if match is not None and record_sets[match].get('SetIdentifier') != wanted.get('SetIdentifier'):
+                    match = None
+                if match is None:
+                    self._invalid_change(wanted, 'it was not found')
+                if (record_sets[match].get('ResourceRecords') != wanted.get('ResourceRecords') or
+                        record_sets[match].get('TTL') != wanted.get('TTL')):
+                    self._invalid_change(wanted, 'the values provided do not match the current values')
+                matches.append(match)
+
+            for i in sorted(set(matches), reverse=True):
+                del record_sets[i]
+            self.indexes.pop(HostedZoneId, None)
+
+        return {'ChangeInfo': {'Status': 'PENDING'}}
+
+    def _invalid_change(self, record_set, reason):
+        """
+        Raise the InvalidChangeBatch error Route53 returns for a DELETE of
+        record_set, e.g. "Tried to delete resource record set
+        [name='a.example.com.', type='A'] but it was not found"
+        """
+        description = "name='{0}', type='{1}'".format(record_set['Name'], record_set['Type'])
+        if record_set.get('SetIdentifier'):
+            description += ", set-identifier='{0}'".format(record_set['SetIdentifier'])
+        raise ClientError({'Error': {'Code': 'InvalidChangeBatch',
+                                     'Message': "Tried to delete resource record set [{0}] but {1}".format(description, reason)}},
+                          'ChangeResourceRecordSets')
+
+
+class FakeEC2(FakeClient):
+
+    def __init__(self, instances, page_size=1000, **kwargs):
+        FakeClient.__init__(self, **kwargs)
+        self.instances = instances
+        self.page_size = page_size
+
+    def get_paginator(self, operation):
+        if operation == 'describe_instances':
+            return FakePaginator(self.describe_instances, 'NextToken', 'NextToken')
+        raise NotImplementedError(operation)
+
+    def describe_instances(self, Filters=None, NextToken=None, MaxResults=None):
+        self._call('DescribeInstances')
+        instances = self.instances
+        for instance_filter in Filters or []:
+            attribute = FILTER_ATTRIBUTES[instance_filter['Name']]
+            values = set(instance_filter['Values'])
+            instances = [instance for instance in instances if instance.get(attribute) in values]
+
+        start = int(NextToken) if NextToken else 0
+        end = start + (MaxResults or self.page_size)
+        response = {'Reservations': [{'Instances': [instance]} for instance in instances[start:end]]}
+        if end < len(instances):
+            response['NextToken'] = str(end)
+        return response
+
+
+def generate_fleet(instances=1000, regions=None, seed=0):
+    """
+    Return {region: [instance dicts]} with unique private and public
+    addresses and the matching EC2 dns names
+    """
+    regions = regions if regions else ['us-east-1']
+    rand = random.Random(seed)
+    fleet = dict((region, []) for region in regions)
+
+    for i in range(instances):
+        region = regions[i % len(regions)]
+        private_ip = str(ipaddress.ip_address('10.0.0.0') + i + 1)
+        public_ip = str(ipaddress.ip_address('54.0.0.0') + i + 1)
+        if region == 'us-east-1':
+            public_dns = "ec2-{0}.compute-1.amazonaws.com".format(public_ip.replace('.', '-'))
+            private_dns = "ip-{0}.ec2.internal".format(private_ip.replace('.', '-'))
+        else:
+            public_dns = "ec2-{0}.{1}.compute.amazonaws.com".format(public_ip.replace('.', '-'), region)
+            private_dns = "ip-{0}.{1}.compute.internal".format(private_ip.replace('.', '-'), region)
+
+        fleet[region].append({'InstanceId': "i-{0:017x}".format(rand.getrandbits(64)),
+                              'PrivateIpAddress': private_ip,
+                              'PublicIpAddress': public_ip,
+                              'PrivateDnsName': private_dns,
+                              'PublicDnsName': public_dns,
+                              'Tags': [{'Key': 'Name', 'Value': "host-{0}".format(i)}]})
+    return fleet
+
+
+def generate_zone(fleet, records=1000, domain='example.com', chain_depth=2, weighted_ratio=0.1, alias_ratio=0.05, orphan_ratio=0.2, seed=0):
+    """
+    Return a list of resource record sets for a synthetic zone. Leaf
+    records point to instances of the fleet (or, for orphan_ratio of
+    them, to addresses that are not in the fleet) and each leaf gets a
+    chain of up to chain_depth CNAMEs pointing to it.
+    """
+    rand = random.Random(seed)
+    instances = [instance for region in sorted(fleet) for instance in fleet[region]]
+    record_sets = []
+    orphan_ip = ipaddress.ip_address('172.16.0.0')
+    i = 0
+
+    while len(record_sets) < records:
+        i += 1
+        name = "host{0}.{1}.".format(i, domain)
+
+        if rand.random() < alias_ratio:
+            record_sets.append({'Name': name, 'Type': 'A',
+                                'AliasTarget': {'HostedZoneId': 'Z35SXDOTRQ7X7K', 'DNSName': "lb-{0}.us-east-1.elb.amazonaws.com.".format(i), 'EvaluateTargetHealth': False}})
+            continue
+
+        orphan = rand.random() < orphan_ratio or not instances
+        instance = rand.choice(instances) if instances else None
+        kind = rand.choice(['A', 'public_dns', 'private_dns'])
+
+        if kind == 'A':
+            value = str(orphan_ip + i) if orphan else instance['PrivateIpAddress']
+            leaf = {'Name': name, 'Type': 'A', 'TTL': 300, 'ResourceRecords': [{'Value': value}]}
+        elif kind == 'public_dns':
+            value = "ec2-{0}.compute-1.amazonaws.com".format(str(orphan_ip + i).replace('.', '-')) if orphan else instance['PublicDnsName']
+            leaf = {'Name': name, 'Type': 'CNAME', 'TTL': 300, 'ResourceRecords': [{'Value': value}]}
+        else:
+            value = "ip-{0}.ec2.internal".format(str(orphan_ip + i).replace('.', '-')) if orphan else instance['PrivateDnsName']
+            leaf = {'Name': name, 'Type': 'CNAME', 'TTL': 300, 'ResourceRecords': [{'Value': value}]}
+
+        if rand.random() < weighted_ratio:
+            for set_id, weight in (('primary', 100), ('secondary', 0)):
+                record_set = dict(leaf, SetIdentifier=set_id, Weight=weight)
+                record_sets.append(record_set)
+        else:
+            record_sets.append(leaf)
+
+        target = name
+        for depth in range(rand.randint(0, chain_depth)):
+            chain_name = "alias{0}-{1}.{2}.".format(i, depth, domain)
+            record_sets.append({'Name': chain_name, 'Type': 'CNAME', 'TTL': 300, 'ResourceRecords': [{'Value': target}]})
+            target = chain_name
+
+        # A few dangling in-domain CNAMEs
+        if orphan and rand.random() < 0.5:
+            record_sets.append({'Name': "dangling{0}.{1}.".format(i, domain), 'Type': 'CNAME', 'TTL': 300,
+                                'ResourceRecords': [{'Value': "gone{0}.{1}.".format(i, domain)}]})
+
+    return record_sets[:records]
@@ -1,14 +1,35 @@
 from botocore.exceptions import ClientError
 from botocore.exceptions import ParamValidationError 
-import boto3
+from collections import OrderedDict
+from contextlib import nullcontext
+from threading import Thread
+import queue
+import os
+import sys
+
+# aws_common is shared by all the tools and lives at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from aws_common import clients
 
 DEBUG = False
+MAX_CHANGES_PER_BATCH = 1000 # Route53 limit on changes in one ChangeBatch
+MAX_VALUES_PER_BATCH = 1000 # Route53 limit on ResourceRecord elements in one ChangeBatch
+
+# Fields of the record tuples built from list_resource_record_sets pages
+RECORD_FIELDS = ('alias', 'weighted', 'weight', 'name', 'norm_name', 'value', 'ttl', 'type', 'set_id')
+
+class RecordFetchError(Exception):
+    """
+    A page of the record listing could not be fetched
+    """
+    pass
 
 class R53AWSClient(object):
 
-    def __init__(self, hosted_zone_id, aws_access_key_id=None, aws_secret_access_key=None):
+    def __init__(self, hosted_zone_id, aws_access_key_id=None, aws_secret_access_key=None, semaphore=None):
         try:
-            self.rc = boto3.client('route53', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+            # Route53 is global, every zone shares one client
+            self.rc = clients.client('route53', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
         except ClientError as e:
             print('Failed to connect to Route53')
             print("{error}".format(error=e))
@@ -16,23 +37,57 @@ class R53AWSClient(object):
 
         self.hosted_zone_id = hosted_zone_id
         self.resource_records = []
+        # Set by iter_resource_record_pages once the last page is yielded
+        self.fetch_complete = False
+
+        # Shared with other clients to cap the number of concurrent calls
+        self.semaphore = semaphore if semaphore else nullcontext()
+
+    def list_hosted_zones(self):
+        """
+        Return (hosted_zone_id, name) for every hosted zone in the account
+        """
+        zones = []
+        if self.rc:
+            try:
+                paginator = self.rc.get_paginator('list_hosted_zones')
+                with self.semaphore:
+                    for page in paginator.paginate():
+                        for zone in page['HostedZones']:
+                            zones.append((zone['Id'].split('/')[-1], zone['Name']))
+            except ClientError as e:
+                print('Failed to list hosted zones')
+                print("{error}".format(error=e))
+        return zones
+
+    def get_hosted_zone_name(self):
+        if self.rc:
+            try:
+                with self.semaphore:
+                    response = self.rc.get_hosted_zone(Id=self.hosted_zone_id)
+                return response['HostedZone']['Name']
+            except ClientError as e:
+                print("Failed to get hosted zone {zone}".format(zone=self.hosted_zone_id))
+                print("{error}".format(error=e))
+        return None
 
     def _get_remaining_record_set(self, next_record_name=None, next_record_type=None):
         """http://boto3.readthedocs.io/en/latest/reference/services/route53.html#Route53.Client.list_resource_record_sets"""
         if self.rc:
             try:
-                if next_record_type and next_record_name:
-                    response = self.rc.list_resource_record_sets(
-                            HostedZoneId = self.hosted_zone_id,
-                            StartRecordName = next_record_name,
-                            StartRecordType = next_record_type,
-                            MaxItems = '100'
-                            )
-                else:
-                    response = self.rc.list_resource_record_sets(
-                            HostedZoneId = self.hosted_zone_id,
-                            MaxItems = '100'
-                            )
+                with self.semaphore:
+                    if next_record_type and next_record_name:
+                        response = self.rc.list_resource_record_sets(
+                                HostedZoneId = self.hosted_zone_id,
+                                StartRecordName = next_record_name,
+                                StartRecordType = next_record_type,
+                                MaxItems = '100'
+                                )
+                    else:
+                        response = self.rc.list_resource_record_sets(
+                                HostedZoneId = self.hosted_zone_id,
+                                MaxItems = '100'
+                                )
             except ClientError as e:
                 print('Failed to get resource record list')
                 print("{error}".format(error=e))
@@ -48,51 +103,50 @@ class R53AWSClient(object):
         return response
 
     def _format_resource_record_set(self, resource_record_set):
+        """
+        Return one tuple per record value, fields as in RECORD_FIELDS
+        """
+        rows = []
+        append = rows.append
         for record in resource_record_set:
             if DEBUG:
                 print(record)
 
-            alias = 0 # Boolean represented as 0 and 1 in sqlite
-            weighted = 0
-            weight = -1
-            ttl = 0
             name = record['Name']
+            norm_name = name.rstrip('.')
             rtype = record['Type']
-            values = []
-            set_id = 'null'
 
-            if 'Weight' in record.keys():
+            if 'Weight' in record:
                 weighted = 1
                 weight = record['Weight']
                 set_id = record['SetIdentifier']
+            else:
+                weighted = 0
+                weight = -1
+                set_id = 'null'
 
-            if 'AliasTarget' in record.keys():
-                alias = 1
-                values.append(record['AliasTarget']['DNSName'])
+            # Booleans represented as 0 and 1 in sqlite
+            if 'AliasTarget' in record:
+                append((1, weighted, weight, name, norm_name, record['AliasTarget']['DNSName'], 0, rtype, set_id))
             else:
                 ttl = record['TTL']
                 for r in record['ResourceRecords']:
-                    values.append(r['Value'].strip('"'))
-
-            # Append data to resource_records
-            for value in values:
-                row = {
-                    'alias': alias,
-                    'weighted': weighted,
-                    'weight': weight,
-                    'name': name,
-                    'value': value,
-                    'ttl': ttl,
-                    'type': rtype,
-                    'set_id': set_id
-                    }
-
-                if DEBUG:
-                    print(row)
-
-                self.resource_records.append(row)
+                    append((0, weighted, weight, name, norm_name, r['Value'].strip('"'), ttl, rtype, set_id))
 
-    def get_all_resource_records(self):
+        if DEBUG:
+            for row in rows:
+                print(row)
+
+        return rows
+
+    def iter_resource_record_pages(self):
+        """
+        Yield the formatted rows of each list_resource_record_sets page
+        as soon as it arrives. Raise RecordFetchError when a page cannot be
+        fetched rather than ending early, a partial listing looks complete.
+        fetch_complete tells whether the last page was reached.
+        """
+        self.fetch_complete = False
         is_truncated = True
         next_record_name = None
         next_record_type = None
@@ -104,38 +158,85 @@ class R53AWSClient(object):
             response = self._get_remaining_record_set(next_record_name, next_record_type)
 
             if response:
-                self._format_resource_record_set(response['ResourceRecordSets'])
+                yield self._format_resource_record_set(response['ResourceRecordSets'])
                 is_truncated = response['IsTruncated']
 
                 if is_truncated:
                     next_record_name = response['NextRecordName']
                     next_record_type = response['NextRecordType']
             else:
-                is_truncated = False
+                raise RecordFetchError("Failed to fetch the records of {zone} after {name} {rtype}".format(
+                    zone=self.hosted_zone_id, name=next_record_name, rtype=next_record_type))
 
-    def delete_record_set(self, name, rtype, value, ttl, set_id=None, weight=None):
-        """http://boto3.readthedocs.io/en/latest/reference/services/route53.html#Route53.Client.change_resource_record_sets"""
-        resource_records = { 'Value': value }
+        self.fetch_complete = True
+
+    def prefetch_resource_record_pages(self, queue_size=4):
+        """
+        Same as iter_resource_record_pages, but fetch the pages in a
+        background thread so the caller can process one page while the
+        next ones are being downloaded
+        """
+        pages = queue.Queue(maxsize=queue_size)
+        done = object()
+
+        def producer():
+            try:
+                for page in self.iter_resource_record_pages():
+                    pages.put(page)
+            except Exception as e:
+                # Re-raised by the consumer, so a failed fetch does not look complete
+                pages.put(e)
+            finally:
+                pages.put(done)
+
+        thread = Thread(target=producer)
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            page = pages.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                thread.join()
+                raise page
+            yield page
+
+        thread.join()
+
+    def get_all_resource_records(self):
+        for page in self.iter_resource_record_pages():
+            self.resource_records.extend(page)
+
+    def _resource_record_set(self, name, rtype, values, ttl, set_id=None, weight=None):
         resource_record_set = { 'Name': name,
                                 'Type': rtype,
                                 'TTL': ttl,
-                                'ResourceRecords': [resource_records],
+                                'ResourceRecords': [{ 'Value': value } for value in values],
                               }
         if set_id:
             resource_record_set['SetIdentifier'] = set_id
             resource_record_set['Weight'] = weight
 
+        return resource_record_set
+
+    def _change_resource_record_sets(self, changes):
+        """http://boto3.readthedocs.io/en/latest/reference/services/route53.html#Route53.Client.change_resource_record_sets"""
+        with self.semaphore:
+            self.rc.change_resource_record_sets(
+                        HostedZoneId= self.hosted_zone_id,
+                        ChangeBatch={
+                            'Comment': 'Deleted part of clean up',
+                            'Changes': changes
+                        })
+
+    def delete_record_set(self, name, rtype, value, ttl, set_id=None, weight=None):
         change_set = { 'Action': 'DELETE',
-                       'ResourceRecordSet': resource_record_set
+                       'ResourceRecordSet': self._resource_record_set(name, rtype, [value], ttl, set_id, weight)
                      }
         if self.rc:
             try:
-                self.rc.change_resource_record_sets(
-                            HostedZoneId= self.hosted_zone_id,
-                            ChangeBatch={
-                                'Comment': 'Deleted part of clean up',
-                                'Changes': [ change_set ]
-                            })
+                self._change_resource_record_sets([ change_set ])
                 return True
             except ClientError as e:
                 print("Failed to delete record {name}".format(name=name))
@@ -143,3 +244,106 @@ class R53AWSClient(object):
                 return False
         else:
             return False
+
+    def _group_record_sets(self, records):
+        """
+        Group (name, rtype, value, ttl, set_id, weight) rows of the same
+        name, type and set_id into one DELETE change each
+        """
+        groups = OrderedDict()
+        for name, rtype, value, ttl, set_id, weight in records:
+            key = (name, rtype, set_id)
+            if key not in groups:
+                groups[key] = (ttl, weight, [])
+            if value not in groups[key][2]:
+                groups[key][2].append(value)
+
+        changes = []
+        for (name, rtype, set_id), (ttl, weight, values) in groups.items():
+            changes.append({ 'Action': 'DELETE',
+                             'ResourceRecordSet': self._resource_record_set(name, rtype, values, ttl, set_id, weight)
+                           })
+        return changes
+
+    def _delete_changes(self, changes, deleted, failed):
+        """
+        Submit the changes as one batch. If Route53 rejects the batch as
+        invalid, split it in half and retry each half to isolate the bad
+        change(s). failed gets (change, error) tuples. Any other error
+        (credentials, permissions, throttling out of retries) would fail
+        every half too, so it is raised.
+        """
+        try:
+            self._change_resource_record_sets(changes)
+            deleted.extend(changes)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidChangeBatch':
+                raise
+            if len(changes) == 1:
+                print("Failed to delete record {name}".format(name=changes[0]['ResourceRecordSet']['Name']))
+                print("{error}".format(error=e))
+                failed.append((changes[0], "{0}".format(e)))
+            else:
+                middle = len(changes) // 2
+                self._delete_changes(changes[:middle], deleted, failed)
+                self._delete_changes(changes[middle:], deleted, failed)
+
+    def plan_change_batches(self, records, batch_size=MAX_CHANGES_PER_BATCH):
+        """
+        Return the list of change lists delete_record_sets would submit.
+        records is an iterable of (name, rtype, value, ttl, set_id, weight).
+        """
+        changes = self._group_record_sets(records)
+
+        # Respect both the change count and the resource record count limits
+        batch = []
+        batch_values = 0
+        batches = []
+        for change in changes:
+            values = len(change['ResourceRecordSet']['ResourceRecords'])
+            if batch and (len(batch) >= batch_size or batch_values + values > MAX_VALUES_PER_BATCH):
+                batches.append(batch)
+                batch = []
+                batch_values = 0
+            batch.append(change)
+            batch_values += values
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def _change_values(self, change):
+        record_set = change['ResourceRecordSet']
+        return [(record_set['Name'], record_set['Type'], r['Value'], record_set['TTL']) for r in record_set['ResourceRecords']]
+
+    def delete_record_sets(self, records, batch_size=MAX_CHANGES_PER_BATCH, on_batch=None):
+        """
+        Delete many records using as few change batches as possible.
+        records is an iterable of (name, rtype, value, ttl, set_id, weight).
+        on_batch(index, deleted_changes, failed_changes) is called after
+        each batch, failed_changes being (change, error) tuples.
+        Return (deleted, failed) as lists of (name, rtype, value, ttl).
+        Errors other than an invalid change batch stop the deletion, after
+        on_batch got the changes of the batch already deleted.
+        """
+        deleted = []
+        failed = []
+
+        if not self.rc:
+            return deleted, failed
+
+        for index, batch in enumerate(self.plan_change_batches(records, batch_size)):
+            deleted_changes = []
+            failed_changes = []
+            try:
+                self._delete_changes(batch, deleted_changes, failed_changes)
+            finally:
+                if on_batch:
+                    on_batch(index, deleted_changes, failed_changes)
+
+            for change in deleted_changes:
+                deleted.extend(self._change_values(change))
+            for change, error in failed_changes:
+                failed.extend(self._change_values(change))
+
+        return deleted, failed
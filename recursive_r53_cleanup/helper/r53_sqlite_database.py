@@ -1,35 +1,146 @@
+from contextlib import contextmanager
 import sqlite3
+import time
+import os
 
 DEBUG = False
 
 class R53SQLDatabase(object):
 
-    def __init__(self, hosted_zone_id, table_name='records'):
+    def __init__(self, hosted_zone_id, table_name='records', in_memory=False, scratch=True):
+        """
+        in_memory: work on an in-memory copy of the database and write it
+        back to disk in close_connection.
+        scratch: trade durability for speed (WAL journal, relaxed fsync).
+        The database can always be rebuilt from Route53.
+        """
         self.db_name = "{0}.db".format(hosted_zone_id)
-        self.connection = sqlite3.connect(self.db_name)
+        self.in_memory = in_memory
+        self.batch_depth = 0
+
+        if in_memory:
+            self.connection = sqlite3.connect(':memory:')
+            if os.path.exists(self.db_name):
+                disk = sqlite3.connect(self.db_name)
+                disk.backup(self.connection)
+                disk.close()
+        else:
+            self.connection = sqlite3.connect(self.db_name)
+            if scratch:
+                self.connection.execute("PRAGMA journal_mode=WAL;")
+                self.connection.execute("PRAGMA synchronous=NORMAL;")
+
         self.table_name = table_name
         self.table_struct = ['alias', 'weighted', 'weight', 'name', 'value', 'ttl', 'type', 'set_id']
+        self.parent_graph = None
+        self.generation = None
 
     def close_connection(self):
         self.connection.commit()
+        if self.in_memory:
+            disk = sqlite3.connect(self.db_name)
+            self.connection.backup(disk)
+            disk.close()
         self.connection.close()
         self.connection = None
 
-    def initialize_database(self):
-        self._drop_table()
-        self._create_table()
+    @contextmanager
+    def batch(self):
+        """
+        Run everything inside the block as a single transaction. Nested
+        batches join the outermost one.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.connection.rollback()
+            raise
+        else:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.connection.commit()
+
+    def initialize_database(self, incremental=False):
+        """
+        Prepare the records table for a new fetch. With incremental the
+        existing rows are kept and upserted, otherwise the table is
+        recreated. Every fetch gets a new generation number.
+        """
+        self.parent_graph = None
+        if not incremental or 'generation' not in self._table_columns():
+            self._drop_table()
+            self._create_table()
+
+        self._create_sync_table()
+        result = self.execute_query("SELECT MAX(generation) FROM {table_name}_sync;".format(table_name=self.table_name))
+        self.generation = (result[0][0] or 0) + 1
+
+    def finish_sync(self):
+        """
+        Delete records not seen in the latest fetch and log the sync.
+        Return (changed, removed) record counts.
+        """
+        query = "SELECT COUNT(*) FROM {table_name} WHERE changed_generation=?;".format(table_name=self.table_name)
+        changed, = self.execute_query(query, (self.generation,))[0]
+
+        query = "DELETE FROM {table_name} WHERE generation<?;".format(table_name=self.table_name)
+        with self.batch():
+            removed = self.connection.execute(query, (self.generation,)).rowcount
+
+        query = "INSERT INTO {table_name}_sync (generation, synced_at, changed, removed) VALUES (?, ?, ?, ?);".format(table_name=self.table_name)
+        self.execute_query(query, (self.generation, int(time.time()), changed, removed))
+        self.parent_graph = None
+
+        return changed, removed
+
+    def get_latest_generation(self):
+        self._create_sync_table()
+        result = self.execute_query("SELECT MAX(generation) FROM {table_name}_sync;".format(table_name=self.table_name))
+        return result[0][0]
+
+    def set_ec2_state(self, rows):
+        """
+        Save EC2 lookup results as (found, id) tuples
+        """
+        query = "UPDATE {table_name} SET ec2_found=?, checked_at={now} WHERE id=?;".format(table_name=self.table_name, now=int(time.time()))
+        if self.connection:
+            with self.batch():
+                self.connection.executemany(query, rows)
+        else:
+            print('No connection to database')
 
     def initialize_delete_db(self):
         self._drop_del_table()
         self._create_del_table()
 
+    def initialize_inventory_db(self):
+        self.execute_query("DROP TABLE IF EXISTS ec2_inventory;")
+        self.execute_query("CREATE TABLE ec2_inventory(filter_key VARCHAR, value VARCHAR, region VARCHAR, instance_id VARCHAR, instance_name VARCHAR, PRIMARY KEY (filter_key, value, region))")
+
+    def upload_inventory(self, rows):
+        if self.connection:
+            with self.batch():
+                self.connection.executemany("INSERT OR REPLACE INTO ec2_inventory (filter_key, value, region, instance_id, instance_name) VALUES (?, ?, ?, ?, ?);", rows)
+        else:
+            print('No connection to database')
+
+    def get_inventory(self):
+        query = "SELECT name FROM sqlite_master WHERE type='table' AND name='ec2_inventory';"
+        if not self.execute_query(query):
+            return []
+        return self.execute_query("SELECT filter_key, value, region, instance_id, instance_name FROM ec2_inventory;")
+
     def execute_query(self, query, values=[]):
         if DEBUG:
             print(query)
         if self.connection:
             c = self.connection.cursor()
             c.execute(query, values)
-            self.connection.commit()
+            if not self.batch_depth:
+                self.connection.commit()
 
             # Return a list of tuples for selects
             if query.lstrip().upper().startswith('SELECT'):
@@ -45,61 +156,234 @@ class R53SQLDatabase(object):
         query = "DROP TABLE IF EXISTS {table_name};".format(table_name=self.table_name)
         self.execute_query(query)
 
+    def _table_columns(self):
+        query = "PRAGMA table_info({table_name});".format(table_name=self.table_name)
+        return [row[1] for row in self.connection.execute(query).fetchall()]
+
     def _create_table(self):
-        query = "CREATE TABLE {table_name}(id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, ttl INTEGER, alias BOOLEAN, weighted BOOLEAN, value VARCHAR, weight INTEGER, type VARCHAR, set_id VARCHAR)".format(table_name=self.table_name)
+        query = "CREATE TABLE {table_name}(id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, norm_name VARCHAR, ttl INTEGER, alias BOOLEAN, weighted BOOLEAN, value VARCHAR, weight INTEGER, type VARCHAR, set_id VARCHAR, generation INTEGER, changed_generation INTEGER, ec2_found BOOLEAN, checked_at INTEGER)".format(table_name=self.table_name)
+        self.execute_query(query)
+        self._create_indexes()
+
+        # Drop the sync history along with the records
+        query = "DROP TABLE IF EXISTS {table_name}_sync;".format(table_name=self.table_name)
         self.execute_query(query)
 
+    def _create_sync_table(self):
+        query = "CREATE TABLE IF NOT EXISTS {table_name}_sync(generation INTEGER PRIMARY KEY, synced_at INTEGER, changed INTEGER, removed INTEGER)".format(table_name=self.table_name)
+        self.execute_query(query)
+
+    def _create_indexes(self):
+        for column in ['norm_name', 'value', 'type']:
+            query = "CREATE INDEX IF NOT EXISTS {table_name}_{column}_idx ON {table_name}({column});".format(table_name=self.table_name, column=column)
+            self.execute_query(query)
+
+        query = "CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_record_idx ON {table_name}(name, type, set_id, value);".format(table_name=self.table_name)
+        self.execute_query(query)
+
+    def _upsert_query(self, placeholders):
+        """
+        Insert a record or, if it already exists, mark it as seen in the
+        current generation. changed_generation only moves when the record
+        data differs from the stored row.
+        """
+        if self.generation is None:
+            self.generation = 1
+
+        return """INSERT INTO {table_name} (alias, weighted, weight, name, norm_name, value, ttl, type, set_id, generation, changed_generation)
+                   VALUES ({placeholders}, {generation}, {generation})
+                   ON CONFLICT(name, type, set_id, value) DO UPDATE SET
+                   changed_generation=CASE WHEN ttl IS NOT excluded.ttl OR alias IS NOT excluded.alias OR weighted IS NOT excluded.weighted OR weight IS NOT excluded.weight
+                                           THEN excluded.generation ELSE changed_generation END,
+                   ttl=excluded.ttl, alias=excluded.alias, weighted=excluded.weighted, weight=excluded.weight,
+                   generation=excluded.generation;""".format(table_name=self.table_name, placeholders=placeholders, generation=int(self.generation))
+
     def _drop_del_table(self):
         query = "DROP TABLE IF EXISTS {table_name}_to_del;".format(table_name=self.table_name)
         self.execute_query(query)
 
     def _create_del_table(self):
-        query = "CREATE TABLE {table_name}_to_del(id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, value VARCHAR, type VARCHAR, ttl INTEGER, set_id VARCHAR, weight INTEGER)".format(table_name=self.table_name)
+        query = "CREATE TABLE {table_name}_to_del(id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, value VARCHAR, type VARCHAR, ttl INTEGER, set_id VARCHAR, weight INTEGER, status VARCHAR DEFAULT 'pending', error VARCHAR, batch_id INTEGER)".format(table_name=self.table_name)
+        self.execute_query(query)
+
+        # A new delete list starts a new journal
+        query = "DROP TABLE IF EXISTS {table_name}_del_batches;".format(table_name=self.table_name)
+        self.execute_query(query)
+        self._ensure_delete_journal()
+
+    def _ensure_delete_journal(self):
+        """
+        Add the journal columns to delete tables created by older versions
+        and create the batch log
+        """
+        query = "PRAGMA table_info({table_name}_to_del);".format(table_name=self.table_name)
+        columns = [row[1] for row in self.connection.execute(query).fetchall()]
+        for column, definition in (('status', "VARCHAR DEFAULT 'pending'"), ('error', 'VARCHAR'), ('batch_id', 'INTEGER')):
+            if column not in columns:
+                query = "ALTER TABLE {table_name}_to_del ADD COLUMN {column} {definition};".format(table_name=self.table_name, column=column, definition=definition)
+                self.execute_query(query)
+
+        query = "CREATE INDEX IF NOT EXISTS {table_name}_to_del_record_idx ON {table_name}_to_del(name, type, set_id, value);".format(table_name=self.table_name)
         self.execute_query(query)
 
+        query = "CREATE TABLE IF NOT EXISTS {table_name}_del_batches(batch_id INTEGER PRIMARY KEY, committed_at INTEGER, deleted INTEGER, failed INTEGER)".format(table_name=self.table_name)
+        self.execute_query(query)
+
+    def get_pending_deletes(self):
+        """
+        Return (name, value, type, ttl, set_id, weight) for every record in
+        the delete table not deleted yet, i.e. pending or failed
+        """
+        self._ensure_delete_journal()
+        query = "SELECT name, value, type, ttl, set_id, weight FROM {table_name}_to_del WHERE status IS NOT 'deleted';".format(table_name=self.table_name)
+        return self.execute_query(query)
+
+    def journal_delete_batch(self, deleted, failed):
+        """
+        Record the outcome of one change batch. deleted is a list of
+        changes, failed a list of (change, error). Return the batch id.
+        """
+        query = "UPDATE {table_name}_to_del SET status=?, error=?, batch_id=? WHERE name=? AND type=? AND set_id=? AND value=?;".format(table_name=self.table_name)
+        with self.batch():
+            result = self.execute_query("SELECT MAX(batch_id) FROM {table_name}_del_batches;".format(table_name=self.table_name))
+            batch_id = (result[0][0] or 0) + 1
+
+            rows = []
+            for status, changes in (('deleted', [(change, None) for change in deleted]), ('failed', failed)):
+                for change, error in changes:
+                    record_set = change['ResourceRecordSet']
+                    for r in record_set['ResourceRecords']:
+                        rows.append((status, error, batch_id, record_set['Name'], record_set['Type'],
+                                     record_set.get('SetIdentifier', 'null'), r['Value']))
+            self.connection.executemany(query, rows)
+
+            query = "INSERT INTO {table_name}_del_batches (batch_id, committed_at, deleted, failed) VALUES (?, ?, ?, ?);".format(table_name=self.table_name)
+            self.execute_query(query, (batch_id, int(time.time()), len(deleted), len(failed)))
+
+        return batch_id
+
 
     def upload_resource_records(self, resource_records):
-        if self.connection:
-            c = self.connection.cursor()
+        """
+        Insert records given as dicts with the table_struct keys or as
+        R53AWSClient record tuples
+        """
+        rows = []
+        for record in resource_records:
+            if DEBUG:
+                print(record)
+
+            if isinstance(record, tuple):
+                rows.append(record)
+            elif set(self.table_struct) == set(record.keys()):
+                rows.append((record['alias'],
+                             record['weighted'],
+                             record['weight'],
+                             record['name'],
+                             record['name'].rstrip('.'),
+                             record['value'],
+                             record['ttl'],
+                             record['type'],
+                             record['set_id']))
+            else:
+                print('Possible malformed input, skipping row')
 
-            for record in resource_records:
-                if DEBUG:
-                    print(record)
+        return self.upload_resource_record_pages([rows])
 
-                if set(self.table_struct) == set(record.keys()):
-                    query = "INSERT INTO {table_name} (alias, weighted, weight, name, value, ttl, type, set_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?);".format(table_name=self.table_name)
+    def upload_resource_record_pages(self, pages):
+        """
+        Insert an iterable of record pages, one executemany per page, all
+        inside a single transaction. Only one page is held in memory.
+        Records are R53AWSClient record tuples, so rows go straight to
+        sqlite without any per-row conversion.
+        """
+        self.parent_graph = None
+        if self.connection:
+            query = self._upsert_query("?, ?, ?, ?, ?, ?, ?, ?, ?")
+            count = 0
+            with self.batch():
+                for page in pages:
+                    self.connection.executemany(query, page)
+                    count += len(page)
                     if DEBUG:
-                        print(query)
-
-                    c.execute(query, (record['alias'],
-                                        record['weighted'],
-                                        record['weight'],
-                                        record['name'],
-                                        record['value'],
-                                        record['ttl'],
-                                        record['type'],
-                                        record['set_id']))
-                else:
-                    print('Possible malformed input, skipping row')
-
-            self.connection.commit()
-            c.close()
+                        print("Inserted {0} records".format(count))
+            return count
         else:
             print('No connection to database')
 
-    def get_parent_records(self, target, final_result=[]):
-        query = "SELECT name, value, type, ttl, weighted, weight, set_id FROM {table_name} WHERE value=?;".format(table_name=self.table_name)
-        result = self.execute_query(query, (target,))
-        if len(result) > 0:
-            for row in result:
-                if row not in final_result:
-                    name, value, rtype, ttl, weighted, weight, set_id = row
-                    if weighted == 1:
-                        if weight != 0:
-                            final_result.append(row)
-                            return self.get_parent_records(name, final_result=final_result)
-                    else:
-                            final_result.append(row)
-                            return self.get_parent_records(name, final_result=final_result)
+    def add_records_to_delete(self, rows):
+        """
+        Insert (name, value, type, ttl, weight, set_id) rows in the delete table
+        """
+        query = "INSERT INTO {table_name}_to_del (name, value, type, ttl, weight, set_id) VALUES (?, ?, ?, ?, ?, ?);".format(table_name=self.table_name)
+        if self.connection:
+            with self.batch():
+                self.connection.executemany(query, rows)
+        else:
+            print('No connection to database')
+
+    def add_dangling_records(self, domain):
+        """
+        Copy every CNAME pointing inside the domain to a name that does not
+        exist in the zone into the delete table, in a single statement.
+        Return the number of records added.
+        """
+        pattern = '%.' + domain.strip('.').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = """INSERT INTO {table_name}_to_del (name, value, type, ttl, weight, set_id)
+                   SELECT r.name, r.value, r.type, r.ttl, r.weight, r.set_id FROM {table_name} r
+                   WHERE r.type='CNAME' AND r.alias=0 AND rtrim(r.value, '.') LIKE ? ESCAPE '\\'
+                   AND NOT EXISTS (SELECT 1 FROM {table_name} p WHERE p.norm_name=rtrim(r.value, '.'));""".format(table_name=self.table_name)
+        if DEBUG:
+            print(query)
+        if self.connection:
+            with self.batch():
+                c = self.connection.execute(query, (pattern,))
+            return c.rowcount
         else:
-            return final_result
+            print('No connection to database')
+
+    def _parent_graph(self):
+        """
+        Build a reverse adjacency map of the records table once.
+        syntax: {value: [(name, value, type, ttl, weighted, weight, set_id), ...]}
+        """
+        if self.parent_graph is None:
+            query = "SELECT name, value, type, ttl, weighted, weight, set_id FROM {table_name};".format(table_name=self.table_name)
+            self.parent_graph = {}
+            for row in self.execute_query(query):
+                self.parent_graph.setdefault(row[1], []).append(row)
+
+        return self.parent_graph
+
+    def get_all_parent_records(self, targets):
+        """
+        Return every record that points, directly or through a chain of
+        records, to any of the targets. Zero weight records are not
+        followed. Each record is returned once, even with cycles.
+        """
+        graph = self._parent_graph()
+        final_result = []
+        seen_rows = set()
+        seen_names = set(targets)
+        pending = list(targets)
+
+        while pending:
+            target = pending.pop()
+            for row in graph.get(target, []):
+                name, value, rtype, ttl, weighted, weight, set_id = row
+                if weighted == 1 and weight == 0:
+                    continue
+                if row in seen_rows:
+                    continue
+
+                seen_rows.add(row)
+                final_result.append(row)
+
+                if name not in seen_names:
+                    seen_names.add(name)
+                    pending.append(name)
+
+        return final_result
+
+    def get_parent_records(self, target):
+        return self.get_all_parent_records([target])
@@ -0,0 +1,52 @@
+import ipaddress
+import re
+
+# EC2 hostname forms. us-east-1 uses its own legacy domains.
+PUBLIC_DNS_PATTERNS = [
+    (re.compile(r'^ec2-(\d{1,3}(?:-\d{1,3}){3})\.compute-1\.amazonaws\.com\.?$', re.IGNORECASE), 'us-east-1'),
+    (re.compile(r'^ec2-(\d{1,3}(?:-\d{1,3}){3})\.([a-z]{2}(?:-[a-z]+)+-\d)\.compute\.amazonaws\.com\.?$', re.IGNORECASE), None),
+]
+PRIVATE_DNS_PATTERNS = [
+    (re.compile(r'^ip-(\d{1,3}(?:-\d{1,3}){3})\.ec2\.internal\.?$', re.IGNORECASE), 'us-east-1'),
+    (re.compile(r'^ip-(\d{1,3}(?:-\d{1,3}){3})\.([a-z]{2}(?:-[a-z]+)+-\d)\.compute\.internal\.?$', re.IGNORECASE), None),
+]
+
+class RecordClassifier(object):
+    """
+    Decide how a record should be checked against EC2. The patterns are
+    compiled once and the region (and ip) encoded in EC2 hostnames is
+    extracted so the lookup can go to a single region.
+    """
+
+    def _match(self, patterns, value):
+        for pattern, region in patterns:
+            match = pattern.match(value)
+            if match:
+                ip = match.group(1).replace('-', '.')
+                try:
+                    ipaddress.ip_address(ip)
+                except ValueError:
+                    # e.g. ec2-300-1-2-3, not a name EC2 hands out
+                    return None
+                return ip, region if region else match.group(2).lower()
+        return None
+
+    def classify(self, rtype, value):
+        """
+        Return (filter_type, region, ip) for records pointing to EC2,
+        region being None when every region has to be searched.
+        Return None for any other record.
+        """
+        if rtype == 'A':
+            return 'ip', None, value
+
+        if rtype == 'CNAME':
+            match = self._match(PUBLIC_DNS_PATTERNS, value)
+            if match:
+                return 'cname', match[1], match[0]
+
+            match = self._match(PRIVATE_DNS_PATTERNS, value)
+            if match:
+                return 'private_dns', match[1], match[0]
+
+        return None
@@ -1,44 +1,104 @@
 from helper.r53_sqlite_database import R53SQLDatabase
 from helper.ec2_aws_client import EC2AWSClient
+from helper.ec2_lookup_cache import EC2LookupCache
+from helper.record_classifier import RecordClassifier
+# The helpers put aws_common on the path
+from aws_common import instrumentation
 import argparse
-import re
+import time
+import sys
 
 DEBUG = False
 
-def add_all_parent_records(result, filter_type):
-    name, value, rtype, ttl, weight, set_id = result
-    output = ec2.search_instance(filter_type, value, verbose=True)
+def add_orphan_records(r53_db, table_name):
+    query = "SELECT name, value, type, ttl, weight, set_id FROM {table_name} WHERE ec2_found=0;".format(table_name=table_name)
+    rows = r53_db.execute_query(query)
 
-    if not output:
-        query = "INSERT INTO {table_name} (name, value, type, ttl, weight, set_id) VALUES (?, ?, ?, ?, ?, ?);".format(table_name=table_name_to_del)
-        if DEBUG:
+    if DEBUG:
+        for name, value, rtype, ttl, weight, set_id in rows:
             print("{0} : {1} : {2}".format(name, rtype, value))
-        r53_db.execute_query(query, (name, value, rtype, ttl, weight, set_id))
-
-        # Get all parent records
-        records_to_delete = r53_db.get_parent_records(name)
-
-        if records_to_delete:
-            for name, value, rtype, ttl, weighted, weight, set_id in records_to_delete:
-                if DEBUG:
-                    print("{0} : {1} : {2}".format(name, rtype, value))
-                r53_db.execute_query(query, (name, value, rtype, ttl, weight, set_id))
-
-def add_if_orphan(result):
-    name, value, rtype, ttl, weight, set_id = result
+    r53_db.add_records_to_delete(rows)
 
-    # Check both example.domain.com and example.domain.com.
-    t_name = value.strip('.')
+    return [row[0] for row in rows]
 
-    query = "SELECT COUNT(*) FROM {table_name} WHERE name=? OR name=?;".format(table_name=table_name).format(table_name=table_name)
-    output = r53_db.execute_query(query, (t_name, t_name+'.'))
-    count, = output[0]
+def add_parent_records(r53_db, names):
+    # Get all parent records
+    records_to_delete = r53_db.get_all_parent_records(names)
 
-    if not count:
-        query = "INSERT INTO {table_name} (name, value, type, ttl, weight, set_id) VALUES (?, ?, ?, ?, ?, ?);".format(table_name=table_name_to_del)
+    rows = []
+    for name, value, rtype, ttl, weighted, weight, set_id in records_to_delete:
         if DEBUG:
             print("{0} : {1} : {2}".format(name, rtype, value))
-        r53_db.execute_query(query, (name, value, rtype, ttl, weight, set_id))
+        rows.append((name, value, rtype, ttl, weight, set_id))
+    r53_db.add_records_to_delete(rows)
+
+def populate_delete_records(r53_db, ec2, domain, table_name='records', batch=False, incremental=False, recheck_after=86400):
+    """
+    Fill the <table_name>_to_del table with orphan records and their parents.
+    Return the number of records to delete.
+    """
+    r53_db.initialize_delete_db()  # Create records_to_del table
+
+    query = "SELECT id, value, type FROM {table_name} WHERE (type='A' OR type='CNAME') AND alias=0".format(table_name=table_name)
+    values = []
+    if incremental:
+        # Only new/changed records and records whose EC2 state is stale
+        query += " AND (changed_generation=? OR checked_at IS NULL OR checked_at<?)"
+        values = [r53_db.get_latest_generation(), int(time.time()) - recheck_after]
+    results = r53_db.execute_query(query + ";", values)
+
+    classifier = RecordClassifier()
+    lookups = []
+    with instrumentation.span('classify'):
+        for row_id, value, rtype in results:
+            classification = classifier.classify(rtype, value)
+            if classification:
+                # EC2 hostnames embed the address of the instance, every
+                # record is looked up by it so the records of one instance
+                # share their cache entries
+                filter_type, region, ip = classification
+                lookups.append((row_id, ip, 'ip', region))
+
+    # CNAMEs pointing to non-existent names in the domain
+    with instrumentation.span('dangling'):
+        count = r53_db.add_dangling_records(domain)
+    if DEBUG:
+        print("{0} dangling records".format(count))
+
+    with instrumentation.span('lookup'):
+        ec2_state = lookup_ec2_state(ec2, lookups, batch)
+
+    with instrumentation.span('insert'), r53_db.batch():
+        r53_db.set_ec2_state(ec2_state)
+
+        # Records pointing to non-existent instances, along with their parents
+        add_parent_records(r53_db, add_orphan_records(r53_db, table_name))
+
+    query = "SELECT COUNT(*) FROM {table_name}_to_del;".format(table_name=table_name)
+    return r53_db.execute_query(query)[0][0]
+
+def lookup_ec2_state(ec2, lookups, batch=False):
+    """
+    lookups: [(row_id, value, filter_type, region)]
+    Return [(found, row_id)]
+    """
+    ec2_state = []
+    if batch:
+        # One search per filter type and region, each packing many values per call
+        grouped = {}
+        for row_id, value, filter_type, region in lookups:
+            grouped.setdefault((filter_type, region), []).append(value)
+
+        found = {}
+        for (filter_type, region), values in grouped.items():
+            found[(filter_type, region)] = ec2.search_instances(filter_type, values, region=region)
+
+        for row_id, value, filter_type, region in lookups:
+            ec2_state.append((1 if found[(filter_type, region)][value] else 0, row_id))
+    else:
+        for row_id, value, filter_type, region in lookups:
+            ec2_state.append((1 if ec2.search_instance(filter_type, value, verbose=False, region=region) else 0, row_id))
+    return ec2_state
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate a simple database of Route53 records')
@@ -47,38 +107,52 @@ if __name__ == "__main__":
     parser.add_argument('--table', '-t', dest='table_name', required=False, default='records', help='Table name in the database')
     parser.add_argument('--hosted-zone-id', '-z', dest='hosted_zone_id', required=True, help='Route53 hosted zone ID')
     parser.add_argument('--domain', '-d', dest='domain', required=True, help='Domain name')
+    parser.add_argument('--inventory', '-i', dest='inventory', action='store_true', help='Fetch all EC2 instances once and search them locally')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=1, help='Number of regions to query in parallel')
+    parser.add_argument('--batch', '-b', dest='batch', action='store_true', help='Look up all records in batched describe_instances calls')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Only look up records changed by the latest incremental fetch or checked too long ago')
+    parser.add_argument('--recheck-after', dest='recheck_after', type=int, default=86400, help='Seconds after which an EC2 lookup result is stale in incremental mode')
+    parser.add_argument('--in-memory', dest='in_memory', action='store_true', help='Work on an in-memory copy of the database and save it at the end')
+    parser.add_argument('--cache', dest='cache', required=False, default=None, help='EC2 lookup cache file, shared between runs and zones')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', type=int, default=86400, help='Seconds a found instance stays in the cache')
+    parser.add_argument('--negative-cache-ttl', dest='negative_cache_ttl', type=int, default=3600, help='Seconds a missing instance stays in the cache')
+    parser.add_argument('--reuse-inventory', dest='reuse_inventory', action='store_true', help='Use the EC2 inventory saved in the database by a previous --inventory run')
+    parser.add_argument('--metrics', dest='metrics', required=False, default=None, help='Write the API call and stage timings to this file, as JSON for .json files and as Prometheus text otherwise')
     args = parser.parse_args()
 
     if DEBUG:
         print("Access key: {0}\nSecret key: {1}\nHosted zone id: {2}\nTable Name: {3}".format(args.access_key_id, args.secret_access_key, args.hosted_zone_id, args.table_name))
 
-    table_name = args.table_name
-    table_name_to_del = "{0}_to_del".format(table_name)
-
     # Create all connection objects
-    r53_db = R53SQLDatabase(args.hosted_zone_id)
-    ec2 = EC2AWSClient(aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key)
-
-    r53_db.initialize_delete_db()  # Create records_to_del table
-
-    query = "SELECT name, value, type, ttl, weight, set_id FROM {table_name} WHERE (type='A' OR type='CNAME') AND alias=0;".format(table_name=table_name)
-    results = r53_db.execute_query(query)
-
-    d_regex = r"\S*\." + re.escape(args.domain) + "\.?$"
-
-    for result in results:
-        name, value, rtype, ttl, weight, set_id = result
-
-        if rtype == 'A':
-            add_all_parent_records(result, 'ip')
-
-        if rtype == 'CNAME':
-            name, value, rtype, ttl, weight, set_id = result
-            if re.search(r'ec2(-\d{1,3}){4}\.compute-1\.amazonaws\.com\.?', value):
-                add_all_parent_records(result, 'cname')
-            elif re.search(r'ip(-\d{1,3}){4}\.ec2\.internal\.?', value):
-                add_all_parent_records(result, 'private_dns')
-            elif re.search(d_regex, value):
-                add_if_orphan(result)
+    r53_db = R53SQLDatabase(args.hosted_zone_id, table_name=args.table_name, in_memory=args.in_memory)
+    cache = EC2LookupCache(args.cache, positive_ttl=args.cache_ttl, negative_ttl=args.negative_cache_ttl) if args.cache else None
+    ec2 = EC2AWSClient(aws_access_key_id=args.access_key_id, aws_secret_access_key=args.secret_access_key, max_workers=args.workers, cache=cache)
+
+    if args.reuse_inventory:
+        rows = r53_db.get_inventory()
+        if not rows:
+            # An empty index would make every EC2 record an orphan
+            print('No saved EC2 inventory, run with --inventory first')
+            r53_db.close_connection()
+            sys.exit(1)
+        ec2.load_inventory(rows)
+    elif args.inventory:
+        ec2.build_inventory()
+        r53_db.initialize_inventory_db()  # Create ec2_inventory table
+        if ec2.inventory_complete():
+            r53_db.upload_inventory(ec2.inventory_rows())
+        else:
+            # Looked up through the API in this run, but not worth reusing
+            print("EC2 inventory incomplete, not saved: {0}".format(', '.join(ec2.inventory_failed_regions)))
+
+    populate_delete_records(r53_db, ec2, args.domain, table_name=args.table_name, batch=args.batch,
+                            incremental=args.incremental, recheck_after=args.recheck_after)
+
+    if cache:
+        print(cache.report())
+        cache.close()
 
     r53_db.close_connection()
+
+    if args.metrics:
+        instrumentation.DEFAULT_RECORDER.write(args.metrics)